@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Measure the result path: evaluating a test for small samples, recording
+# the outcomes and reporting them, at the scale of many test units.
+#
+# Usage: python3 benchmarks/results.py [-n units] [-r repeats]
+#
+# Results are printed as json (microseconds per unit) so that they can be
+# stored and compared between versions.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(root, "src"))
+
+import numpy as np
+from grid_check.check import add_status, report
+from grid_check.tests import EnvelopeTest, MeanTest
+
+TESTS = {
+    "MEAN": (MeanTest, {"MinAllowed": 0, "MaxAllowed": 100}),
+    "ENVELOPE": (EnvelopeTest, {"MinAllowed": 0, "MaxAllowed": 100}),
+}
+
+
+def units(count):
+    """Samples and forecast types of count units of an ensemble"""
+
+    analysis_time = datetime(2024, 1, 1)
+
+    for i in range(count):
+        lt = timedelta(hours=i % 48)
+        ft = {
+            "Grib2MetaData": [
+                {"Key": "typeOfProcessedData", "Value": 4},
+                {"Key": "perturbationNumber", "Value": i % 51},
+            ]
+        }
+        sample = {
+            "Parameter": "Temperature",
+            "Values": np.arange(100.0),
+            "Indices": None,
+            "AnalysisTime": analysis_time,
+            "ForecastTime": analysis_time + lt,
+        }
+
+        yield ft, lt, sample
+
+
+def measure(classname, limits, count, level):
+    logging.getLogger().setLevel(level)
+
+    test = {"Name": "benchmark", "Sample": "100%", "Test": limits}
+    ret = {"success": 0, "fail": 0, "skip": 0, "summary": []}
+    evaluate = 0.0
+    record = 0.0
+
+    for ft, lt, sample in units(count):
+        start = time.perf_counter()
+        status = classname(test)(sample)
+        middle = time.perf_counter()
+        add_status(ret, status, sample, ft, lt)
+        end = time.perf_counter()
+
+        evaluate += middle - start
+        record += end - middle
+
+    start = time.perf_counter()
+    report([ret])
+    reporting = time.perf_counter() - start
+
+    return {
+        "evaluate_us": round(evaluate / count * 1e6, 2),
+        "record_us": round(record / count * 1e6, 2),
+        "report_us": round(reporting / count * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--units", type=int, default=100000)
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    # messages are formatted but not written anywhere
+    logging.basicConfig(handlers=[logging.NullHandler()])
+
+    result = {"units": args.units}
+
+    for name, (classname, limits) in TESTS.items():
+        for level_name in ["WARNING", "INFO"]:
+            runs = [
+                measure(classname, {"Type": name, **limits}, args.units, level_name)
+                for _ in range(args.repeats)
+            ]
+            result[f"{name}_{level_name.lower()}"] = {
+                k: min(r[k] for r in runs) for k in runs[0]
+            }
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
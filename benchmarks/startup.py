@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Measure import time of grid_check and startup time of grid-check.py.
+#
+# Usage: python3 benchmarks/startup.py [-n repeats]
+#
+# Results are printed as json so that they can be stored and compared
+# between versions.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that should not be imported unless they are needed
+HEAVY_MODULES = ["eccodes", "gribapi", "fsspec", "s3fs", "pydash"]
+
+env = dict(os.environ)
+env["PYTHONPATH"] = os.path.join(root, "src") + os.pathsep + env.get("PYTHONPATH", "")
+
+
+def run(args):
+    start = time.perf_counter()
+    subprocess.run(args, env=env, check=True, capture_output=True)
+    return time.perf_counter() - start
+
+
+def import_time():
+    """Cumulative import time of grid_check in microseconds, from -X importtime"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import grid_check"],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+    for line in proc.stderr.splitlines():
+        fields = [x.strip() for x in line.split("|")]
+        if len(fields) == 3 and fields[2] == "grid_check":
+            return int(fields[1])
+
+
+def imported_heavy_modules():
+    code = "import sys, grid_check; print(' '.join(sorted(sys.modules)))"
+    proc = subprocess.run(
+        [sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True
+    )
+    modules = proc.stdout.split()
+    return [m for m in HEAVY_MODULES if m in modules]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.repeats)]
+    helps = [
+        run([sys.executable, os.path.join(root, "grid-check.py"), "--help"])
+        for _ in range(args.repeats)
+    ]
+
+    result = {
+        "import_grid_check_us": min(imports),
+        "grid_check_help_s": round(min(helps), 4),
+        "heavy_modules_imported": imported_heavy_modules(),
+    }
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,36 @@
 
 import sys
 import argparse
+import json
 import logging
-from grid_check import parse_configuration_file, check, index_grib_files
+from grid_check.results import report, report_batch, to_json
+
+
+def parse_shard(value):
+    try:
+        shard, count = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}, expected i/N")
+
+    if count < 1 or shard < 0 or shard >= count:
+        raise argparse.ArgumentTypeError(f"invalid shard: {value}, expected 0 <= i < N")
+
+    return shard, count
+
+
+def parse_log_level(level):
+    if level == 1:
+        return logging.CRITICAL
+    elif level == 2:
+        return logging.ERROR
+    elif level == 3:
+        return logging.WARNING
+    elif level == 4:
+        return logging.INFO
+    elif level == 5:
+        return logging.DEBUG
+    return level
+
 
 def parse_command_line():
     parser = argparse.ArgumentParser()
@@ -11,7 +39,8 @@ def parse_command_line():
         "-c",
         "--configuration",
         type=str,
-        help="configuration file for checker",
+        action="append",
+        help="configuration file for checker, can be given multiple times",
         required=True,
     )
     parser.add_argument(
@@ -30,43 +59,273 @@ def parse_command_line():
         default=False,
     )
     parser.add_argument(
-        "files", type=str, help="input files to check", action="append", nargs="+"
+        "--serve",
+        type=str,
+        metavar="ADDRESS",
+        help="run as a check service at [host]:port or unix:<path>",
+    )
+    parser.add_argument(
+        "--server",
+        type=str,
+        metavar="ADDRESS",
+        help="send check to a service running at [host]:port or unix:<path>",
+    )
+    parser.add_argument(
+        "--allow-remote",
+        action="store_true",
+        help="allow serving checks at a non-loopback tcp address; the service has no authentication and reads any file a client asks for",
+        default=False,
+    )
+    parser.add_argument(
+        "--max-grids",
+        type=int,
+        help="number of decoded grids kept in memory between checks in service mode, over all checked files",
+        default=64,
+    )
+    parser.add_argument(
+        "--index",
+        type=str,
+        action="append",
+        help="external index file (wgrib2 inventory or eccodes index) of an input file, given once for each input file in the same order",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="I/N",
+        help="check only shard I (0..N-1) of N and write partial results, combine them with 'merge'",
+    )
+    parser.add_argument(
+        "--output",
+        type=str,
+        help="file for partial results of a shard, default stdout",
+        default="-",
+    )
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        help="number of worker processes for decoding grib messages, default 0 (decode in main process)",
+        default=0,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="number of grid points evaluated at a time, default 1048576",
+    )
+    parser.add_argument(
+        "--configuration-cache",
+        type=str,
+        metavar="DIRECTORY",
+        help="cache parsed configurations in directory, and reuse them while configuration and included files are unchanged",
+    )
+    parser.add_argument(
+        "files",
+        type=str,
+        help="input files to check, '-' to read a grib stream from stdin",
+        action="append",
+        nargs="*",
     )
     args = parser.parse_args()
 
-    if args.log_level == 1:
-        args.log_level = logging.CRITICAL
-    elif args.log_level == 2:
-        args.log_level = logging.ERROR
-    elif args.log_level == 3:
-        args.log_level = logging.WARNING
-    elif args.log_level == 4:
-        args.log_level = logging.INFO
-    elif args.log_level == 5:
-        args.log_level = logging.DEBUG
+    if args.serve is not None:
+        if len(args.files[0]) > 0:
+            parser.error("input files cannot be given in service mode")
+    elif len(args.files[0]) == 0:
+        parser.error("input files must be given")
+
+    if args.server is not None and args.patch is not None:
+        parser.error("patches cannot be used with a check service")
+
+    if args.server is not None:
+        # the client does not import the modules for reading data
+        streams = [x for x in args.files[0] if x == "-"]
+        if len(streams) > 0:
+            parser.error("a stream cannot be checked with a check service")
+    else:
+        from grid_check import is_stream
+
+        streams = [x for x in args.files[0] if is_stream(x)]
+
+    if len(streams) > 0 and len(args.files[0]) > 1:
+        parser.error("a stream must be the only input")
+    if len(streams) > 0 and len(args.configuration) > 1:
+        parser.error("a stream can be checked with only one configuration")
+
+    if args.index is not None:
+        if len(args.index) != len(args.files[0]):
+            parser.error("--index must be given once for each input file")
+        if len(streams) > 0 or args.server is not None:
+            parser.error("index files cannot be used with a stream or a check service")
+
+    if args.shard is not None:
+        if len(streams) > 0:
+            parser.error("a stream cannot be sharded")
+        if args.serve is not None or args.server is not None:
+            parser.error("shards cannot be used with a check service")
+
+    args.log_level = parse_log_level(args.log_level)
 
     return args
 
 
-def main():
-    args = parse_command_line()
+def parse_merge_command_line():
+    parser = argparse.ArgumentParser(
+        prog="grid-check.py merge",
+        description="combine partial results of all shards of a check",
+    )
+    parser.add_argument("-d", "--log-level", type=int, help="log level 1-5", default=4)
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="exit if error if any test fails or is skipped",
+        default=False,
+    )
+    parser.add_argument(
+        "partials", type=str, help="partial result files written with --shard", nargs="+"
+    )
+    args = parser.parse_args(sys.argv[2:])
+
+    args.log_level = parse_log_level(args.log_level)
+
+    return args
+
+
+def setup_logging(log_level):
     logging.basicConfig(
         format="%(asctime)s %(levelname)-8s %(message)s",
-        level=args.log_level,
+        level=log_level,
         datefmt="%Y-%m-%d %H:%M:%S",
     )
 
-    config, forecast_types, leadtimes, parameters = parse_configuration_file(
-        args.configuration, args.patch
+
+def merge():
+    from grid_check import merge_shards
+
+    args = parse_merge_command_line()
+    setup_logging(args.log_level)
+
+    partials = []
+
+    for partial in args.partials:
+        with open(partial) as fp:
+            partials.append(json.load(fp))
+
+    all_results = merge_shards(partials)
+
+    if len(all_results) == 1:
+        return report(all_results[0][1], args.strict)["return_code"]
+
+    return max(report_batch(all_results, args.strict).values())
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        return merge()
+
+    args = parse_command_line()
+    setup_logging(args.log_level)
+
+    # eccodes is imported lazily after logging is configured, keep its
+    # library loading messages out of debug output
+    logging.getLogger("findlibs").setLevel(logging.WARNING)
+    logging.getLogger("gribapi").setLevel(logging.WARNING)
+
+    if args.server is not None:
+        # only the client is imported, not the modules for checking
+        from grid_check.client import CheckRequestError, request_check
+
+        return_code = 0
+        for configuration in args.configuration:
+            try:
+                ret = request_check(args.server, configuration, args.files[0], args.strict)
+            except CheckRequestError as e:
+                logging.error(e)
+                return 1
+
+            return_code = max(return_code, report(ret["results"], args.strict)["return_code"])
+
+        return return_code
+
+    pool = None
+
+    if args.decode_workers > 0:
+        from grid_check.decode import DecodePool
+
+        pool = DecodePool(args.decode_workers)
+
+    try:
+        return check_files(args, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def check_files(args, pool):
+    from grid_check import (
+        parse_configuration_file,
+        check,
+        check_batch,
+        check_shard,
+        check_stream,
+        compile_demand,
+        compile_plans,
+        index_grib_files,
+        is_stream,
     )
 
-    dims = {
-        "forecast_types": forecast_types,
-        "leadtimes": leadtimes,
-        "parameters": parameters,
-    }
+    configurations = []
+
+    for configuration in args.configuration:
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            configuration, args.patch, args.configuration_cache
+        )
+
+        if args.chunk_size is not None:
+            # the default of tests that do not set ChunkSize themselves
+            for test in config["Tests"]:
+                test.setdefault("ChunkSize", args.chunk_size)
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        configurations.append((configuration, config, dims))
+
+    if args.serve is not None:
+        from grid_check.server import serve
+
+        return serve(args.serve, configurations, args.max_grids, args.allow_remote, pool)
+
+    if args.shard is not None:
+        partial = check_shard(configurations, args.files, *args.shard, args.index, pool)
+
+        if args.output == "-":
+            json.dump(partial, sys.stdout, default=to_json)
+        else:
+            with open(args.output, "w") as fp:
+                json.dump(partial, fp, default=to_json)
+
+        return 0
+
+    if len(configurations) > 1:
+        return max(
+            check_batch(configurations, args.files, args.strict, args.index, pool).values()
+        )
+
+    plans = compile_plans(config, dims)
+    input_file = args.files[0][0]
+
+    if is_stream(input_file):
+        if input_file == "-":
+            return check_stream(config, dims, sys.stdin.buffer, args.strict, plans, pool)
+
+        with open(input_file, "rb") as fp:
+            return check_stream(config, dims, fp, args.strict, plans, pool)
+
+    index = index_grib_files(args.files, compile_demand(config, dims, plans), args.index)
 
-    return check(config, dims, index_grib_files(args.files), args.strict)
+    return check(config, dims, index, args.strict, plans, pool)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,45 @@
-from . import check
-from .check import check, parse_configuration_file
-from .fileutils import index_grib_files
+import importlib
+import sys
+import types
 
 __VERSION__ = "0.0.1"
 
+# Public names and the modules they are defined in. A module is imported
+# only when one of its names is first used, so that light users of the
+# package, like the check service client, do not import numpy or yaml.
+EXPORTS = {
+    "check": ".check",
+    "check_batch": ".check",
+    "check_shard": ".check",
+    "check_stream": ".check",
+    "compile_demand": ".check",
+    "compile_plans": ".check",
+    "execute_plans": ".check",
+    "merge_shards": ".check",
+    "parse_configuration_file": ".check",
+    "report": ".results",
+    "report_batch": ".results",
+    "index_grib_files": ".fileutils",
+    "is_stream": ".fileutils",
+}
+
+
+class Package(types.ModuleType):
+    def __getattr__(self, name):
+        if name not in EXPORTS:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+        value = getattr(importlib.import_module(EXPORTS[name], __name__), name)
+        setattr(self, name, value)
+
+        return value
+
+    def __setattr__(self, name, value):
+        # importing submodule check would replace function check
+        if name == "check" and isinstance(value, types.ModuleType):
+            return
+
+        super().__setattr__(name, value)
+
+
+sys.modules[__name__].__class__ = Package
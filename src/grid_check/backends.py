@@ -0,0 +1,319 @@
+import logging
+import numpy as np
+from datetime import datetime, timedelta
+from .constants import *
+
+# grib keys are read from variable (or global) attributes with this prefix,
+# for example GRIB_discipline, like cfgrib writes them
+ATTRIBUTE_PREFIX = "GRIB_"
+
+# names of dimensions that are index keys, in addition to key names
+DIMENSION_ALIASES = {"step": "endStep", "number": "perturbationNumber"}
+
+# attributes that declare the value of missing points, like xarray and the
+# CF conventions write them
+FILL_ATTRIBUTES = ["_FillValue", "missing_value"]
+
+
+def declared_fill_value(attrs):
+    """
+    Return the declared value of missing points, or None. The fill value of
+    the storage format itself is not used: zarr arrays have fill value 0 by
+    default, and 0 is a valid value.
+    """
+
+    for k in FILL_ATTRIBUTES:
+        if attrs.get(k) is not None:
+            return attrs[k]
+
+    return None
+
+
+def detect_backend(file_name):
+    """
+    Return name of the backend for a file, or None for grib. Grib files are
+    not read through a backend: messages are located and decoded by
+    fileutils, which also reads index files and message headers and decodes
+    in worker processes, and none of that is available through backends.
+    """
+
+    name = file_name.rstrip("/")
+
+    if name.endswith(".zarr"):
+        return "zarr"
+    if name.endswith((".nc", ".nc4", ".netcdf")):
+        return "netcdf"
+
+    return None
+
+
+class LazyValues:
+    """
+    Values of one field that are read only when needed. take() reads only
+    the chunks that contain the requested points.
+    """
+
+    def __init__(self, read_block, shape, chunks, fill_value=None):
+        self.read_block = read_block
+        self.shape = tuple(shape)
+        self.chunks = tuple(chunks)
+        self.fill_value = fill_value
+        self.size = int(np.prod(self.shape))
+        # number of values that are not missing, if known without reading
+        self.valid_size = None
+        self.chunks_read = 0
+
+    def mask(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        missing = np.isnan(values)
+
+        if self.fill_value is not None and not np.isnan(self.fill_value):
+            missing |= values == self.fill_value
+
+        return np.ma.masked_where(missing, values)
+
+    def read(self):
+        """Read all values as a flat masked array"""
+
+        self.chunks_read += int(
+            np.prod([-(-n // c) for n, c in zip(self.shape, self.chunks)])
+        )
+        return self.mask(self.read_block(tuple(slice(0, n) for n in self.shape))).ravel()
+
+    def take(self, indices):
+        """Read values at flat indices as a masked array"""
+
+        coords = np.unravel_index(indices, self.shape)
+        chunk_no = np.ravel_multi_index(
+            [c // s for c, s in zip(coords, self.chunks)],
+            [-(-n // s) for n, s in zip(self.shape, self.chunks)],
+        )
+
+        values = np.empty(len(indices), dtype=np.float64)
+        order = np.argsort(chunk_no, kind="stable")
+        bounds = np.flatnonzero(np.diff(chunk_no[order])) + 1
+
+        for group in np.split(order, bounds):
+            if group.size == 0:
+                continue
+
+            start = [c[group[0]] // s * s for c, s in zip(coords, self.chunks)]
+            block = np.asarray(
+                self.read_block(
+                    tuple(slice(b, b + s) for b, s in zip(start, self.chunks))
+                )
+            )
+            self.chunks_read += 1
+
+            values[group] = block[tuple(c[group] - b for c, b in zip(coords, start))]
+
+        return self.mask(values)
+
+
+def analysis_time(attrs):
+    dd = int(attrs[ATTRIBUTE_PREFIX + "dataDate"])
+    dt = int(attrs.get(ATTRIBUTE_PREFIX + "dataTime", 0))
+
+    return datetime.strptime(f"{dd}{dt:04d}", "%Y%m%d%H%M")
+
+
+def coordinate_values(values):
+    values = np.asarray(values)
+
+    if np.issubdtype(values.dtype, np.timedelta64):
+        # cfgrib style steps
+        return (values / np.timedelta64(1, "h")).astype(int)
+
+    return values.astype(int)
+
+
+def index_variables(backend, path):
+    """
+    Map variables of a dataset onto index keys. Key values are read from
+    attributes, or from coordinates of leading dimensions that are index
+    keys: each position along them is a separate field. The remaining,
+    trailing dimensions are the grid. Yields index entries.
+    """
+
+    dataset = backend.open(path)
+    global_attrs = backend.global_attributes(dataset)
+
+    for name, dims, attrs in backend.variables(dataset):
+        attrs = {**global_attrs, **attrs}
+        key_dims = []
+
+        for dim in dims:
+            key = DIMENSION_ALIASES.get(dim, dim)
+            if key not in INDEX_KEYS:
+                break
+            key_dims.append((dim, key))
+
+        if len(key_dims) == len(dims) or any(
+            ATTRIBUTE_PREFIX + k not in attrs and k not in [key for dim, key in key_dims]
+            for k in ["discipline", "parameterCategory", "parameterNumber"]
+        ):
+            logging.debug(f"Variable {name} of {path} is not a parameter, skipped")
+            continue
+
+        try:
+            analysis_time(attrs)
+        except (KeyError, ValueError) as e:
+            logging.warning(f"Analysis time of variable {name} of {path} not found, skipped")
+            continue
+
+        coords = [coordinate_values(backend.coordinate(dataset, dim)) for dim, key in key_dims]
+
+        for position in np.ndindex(*[len(c) for c in coords]):
+            values = {
+                k: int(attrs[ATTRIBUTE_PREFIX + k])
+                for k in INDEX_KEYS
+                if ATTRIBUTE_PREFIX + k in attrs
+            }
+
+            for (dim, key), c, i in zip(key_dims, coords, position):
+                values[key] = int(c[i])
+
+            yield {
+                "key": tuple(values.get(k) for k in INDEX_KEYS),
+                "backend": backend.name,
+                "variable": name,
+                "position": list(position),
+            }
+
+
+def read_variable(backend, grid, header_only=False):
+    """
+    Return the values of one field of a variable as LazyValues, and its
+    times.
+    """
+
+    dataset = backend.open(grid["file_name"])
+    attrs = {
+        **backend.global_attributes(dataset),
+        **backend.attributes(dataset, grid["variable"]),
+    }
+
+    ret = {}
+
+    ret["AnalysisTime"] = analysis_time(attrs)
+    ret["ForecastTime"] = ret["AnalysisTime"]
+
+    dims = backend.dimensions(dataset, grid["variable"])
+
+    for dim, i in zip(dims, grid["position"]):
+        if DIMENSION_ALIASES.get(dim, dim) == "endStep":
+            step = coordinate_values(backend.coordinate(dataset, dim))[i]
+            ret["ForecastTime"] = ret["AnalysisTime"] + timedelta(hours=int(step))
+
+    if ATTRIBUTE_PREFIX + "endStep" in attrs:
+        ret["ForecastTime"] = ret["AnalysisTime"] + timedelta(
+            hours=int(attrs[ATTRIBUTE_PREFIX + "endStep"])
+        )
+
+    if header_only:
+        return ret
+
+    position = tuple(grid["position"])
+    shape, chunks, fill_value = backend.layout(dataset, grid["variable"])
+    read = backend.reader(dataset, grid["variable"])
+
+    ret["Values"] = LazyValues(
+        lambda block: read(position + block),
+        shape[len(position) :],
+        chunks[len(position) :],
+        fill_value,
+    )
+
+    return ret
+
+
+class ZarrBackend:
+    name = "zarr"
+
+    def open(self, path):
+        try:
+            import zarr
+        except ImportError as e:
+            raise ImportError(f"zarr is needed to read {path}") from e
+
+        return zarr.open_group(path, mode="r")
+
+    def global_attributes(self, dataset):
+        return dict(dataset.attrs)
+
+    def attributes(self, dataset, name):
+        return dict(dataset[name].attrs)
+
+    def dimensions(self, dataset, name):
+        arr = dataset[name]
+        dims = getattr(arr.metadata, "dimension_names", None)
+
+        if dims is None:
+            # xarray convention for zarr v2
+            dims = arr.attrs.get("_ARRAY_DIMENSIONS", [])
+
+        return list(dims)
+
+    def variables(self, dataset):
+        for name, arr in dataset.arrays():
+            yield name, self.dimensions(dataset, name), dict(arr.attrs)
+
+    def coordinate(self, dataset, dim):
+        return dataset[dim][:]
+
+    def layout(self, dataset, name):
+        arr = dataset[name]
+        return arr.shape, arr.chunks, declared_fill_value(dict(arr.attrs))
+
+    def reader(self, dataset, name):
+        arr = dataset[name]
+        return lambda block: arr[block]
+
+
+class NetCDFBackend:
+    name = "netcdf"
+
+    def open(self, path):
+        try:
+            import netCDF4
+        except ImportError as e:
+            raise ImportError(f"netCDF4 is needed to read {path}") from e
+
+        ds = netCDF4.Dataset(path, mode="r")
+        ds.set_auto_mask(False)
+
+        return ds
+
+    def global_attributes(self, dataset):
+        return {k: dataset.getncattr(k) for k in dataset.ncattrs()}
+
+    def attributes(self, dataset, name):
+        var = dataset.variables[name]
+        return {k: var.getncattr(k) for k in var.ncattrs()}
+
+    def dimensions(self, dataset, name):
+        return list(dataset.variables[name].dimensions)
+
+    def variables(self, dataset):
+        for name in dataset.variables:
+            yield name, self.dimensions(dataset, name), self.attributes(dataset, name)
+
+    def coordinate(self, dataset, dim):
+        return dataset.variables[dim][:]
+
+    def layout(self, dataset, name):
+        var = dataset.variables[name]
+        chunks = var.chunking()
+
+        if chunks == "contiguous":
+            # one field at a time
+            chunks = [1] * (var.ndim - 2) + list(var.shape[-2:])
+
+        return var.shape, chunks, declared_fill_value(self.attributes(dataset, name))
+
+    def reader(self, dataset, name):
+        var = dataset.variables[name]
+        return lambda block: var[block]
+
+
+BACKENDS = {"zarr": ZarrBackend(), "netcdf": NetCDFBackend()}
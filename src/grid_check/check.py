@@ -2,19 +2,46 @@ import yaml
 import numpy as np
 import logging
 import copy
+import hashlib
 import os
+import pickle
+from collections import OrderedDict
 from random import randrange
 from datetime import timedelta
 from .tests import *
-from .fileutils import read_grids
+from .backends import LazyValues
+from .results import Summary, format_metadata_to_string, report, report_batch
+from .fileutils import (
+    GridCache,
+    index_grib_files,
+    read_grids,
+    read_grib_stream,
+    message_key,
+    conditions_to_key,
+    format_key_to_string,
+)
 from .constants import *
-import pydash
 
 
 class TestNotImplementedException(Exception):
     pass
 
 
+# position of each index key in index key tuples
+KEY_POSITION = {k: i for i, k in enumerate(INDEX_KEYS)}
+
+# parameter name suffix for data of the previous leadtime
+PREVIOUS_SUFFIX = ":previous"
+
+# lazily read grids are sampled point by point if the sample is at most this
+# fraction of the grid, otherwise they are read whole
+SPARSE_FRACTION = 0.05
+
+# flags of test classes that do not sample grids one by one, and cannot be
+# run on preprocessed grids
+SAMPLE_FLAGS = ["temporal", "spatial", "shared", "ensemble"]
+
+
 def get_default_value(keyname):
     if keyname == "typeOfProcessedData":
         return 1  # deterministic
@@ -39,27 +66,82 @@ def forecast_type_from_grib(gid):
         return "unknown"
 
 
-def read_sample(grids, sample_size, remove_missing=True):
+class SampleOrders:
+    """
+    Random orders of grid points by grid size, kept between checks so that
+    random indices are not drawn again for every sample. A sample is the
+    first points of the order that are not missing, so grids of the same
+    size are sampled at the same points. Orders of up to max_sizes grid
+    sizes are kept, least recently used first out.
+    """
+
+    def __init__(self, max_sizes=4):
+        self.orders = OrderedDict()
+        self.max_sizes = max_sizes
+
+    def order(self, size):
+        order = self.orders.get(size)
+
+        if order is None:
+            order = np.random.default_rng().permutation(size)
+            self.orders[size] = order
+
+        self.orders.move_to_end(size)
+
+        while len(self.orders) > self.max_sizes:
+            self.orders.popitem(last=False)
+
+        return order
+
+    def choice(self, mask, sample_size):
+        """
+        Return sample_size indices where mask is not set, in random order.
+        """
+
+        order = self.order(mask.size)
+        count = sample_size
+
+        while True:
+            candidates = order[:count]
+            indices = candidates[~mask[candidates]]
+
+            if indices.size >= sample_size or count >= order.size:
+                return indices[:sample_size]
+
+            count = min(order.size, 2 * count)
+
+
+def read_sample(grids, sample_size, remove_missing=True, orders=None):
+    """
+    Take a random sample of each grid. The grid indices of the sampled
+    values are stored in key "Indices" and the size of the grid in key
+    "GridSize", so that tests can relate the sample to other gridded data.
+    If the sample covers the whole grid, the grid is
+    not copied: values are returned as a masked array and "Indices" is None.
+
+    If orders (SampleOrders) is given, samples are taken from its random
+    orders of grid points.
+    """
+
     if grids is None or len(grids) == 0:
         return []
 
     def sample_without_missing_values(g):
         nonlocal sample_size
-        # remove missing values
-        ngrid = g.compressed()
+        valid_size = g.size - np.ma.count_masked(g)
 
         if "%" in str(sample_size):
-            sample_size = int(float(sample_size[:-1]) * 0.01 * ngrid.size)
+            sample_size = int(float(sample_size[:-1]) * 0.01 * valid_size)
 
-        if g.size == 0:
+        if valid_size == 0:
             logging.warning("All elements of grid are missing")
-            return None
+            return None, None
 
         # If grid size after removing missing values is smaller than requested
         # sample size, don't generate a sample
 
-        if ngrid.size < sample_size:
-            valid_ratio = float(ngrid.size) / g.size
+        if valid_size < sample_size:
+            valid_ratio = float(valid_size) / g.size
 
             logging.warning(
                 "{:.1f}% of grid elements are missing, cannot generate a sample".format(
@@ -67,42 +149,409 @@ def read_sample(grids, sample_size, remove_missing=True):
                 ),
             )
 
-            return None
+            return None, None
 
-        if sample_size == ngrid.size:
-            # return all values
-            return ngrid
+        if sample_size == valid_size:
+            # sample is the whole grid: return it as is, tests skip the
+            # missing values chunk by chunk
+            return None, g
 
-        return np.random.choice(ngrid, sample_size, replace=False)
+        # remove missing values
+        if orders is not None:
+            indices = orders.choice(np.ma.getmaskarray(g), sample_size)
+        else:
+            valid = np.flatnonzero(~np.ma.getmaskarray(g))
+            indices = np.random.choice(valid, sample_size, replace=False)
+
+        return indices, np.ma.getdata(g)[indices]
 
     def sample_with_missing_values(g):
         nonlocal sample_size
         if "%" in str(sample_size):
             sample_size = int(int(sample_size[:-1]) * 0.01 * g.size)
 
-        # return masked array to normal array
-        ngrid = g.data
-
-        # select a random sample
-        sample = np.random.choice(ngrid, sample_size, replace=False)
+        if sample_size == g.size:
+            return None, g
 
-        # apply mask once again
-        sample = np.ma.masked_where(sample == MISS, sample)
-
-        return sample
+        # select a random sample, mask is retained
+        if orders is not None:
+            indices = orders.order(g.size)[:sample_size]
+        else:
+            indices = np.random.choice(g.size, sample_size, replace=False)
 
-    ret = []
+        return indices, np.ma.masked_array(g)[indices]
 
     func = (
         sample_without_missing_values if remove_missing else sample_with_missing_values
     )
 
     for g in grids:
-        g["Values"] = func(g["Values"])
+        g["GridSize"] = g["Values"].size
+
+        if isinstance(g["Values"], LazyValues):
+            values = g["Values"]
+            count = sample_count(values, sample_size, remove_missing)
+
+            if count is not None and count <= SPARSE_FRACTION * values.size:
+                g["Indices"], g["Values"] = sample_lazy(values, count, remove_missing)
+                continue
+
+            g["Values"] = values.read()
+
+        g["Indices"], g["Values"] = func(g["Values"])
+
+    return grids
+
+
+def sample_count(values, sample_size, remove_missing=True):
+    """
+    Return the number of points to sample from lazily read values, or None
+    if it is not known without reading all values.
+    """
+
+    if "%" not in str(sample_size):
+        return int(sample_size)
+
+    size = values.valid_size if remove_missing else values.size
+
+    if size is None:
+        return None
+
+    return int(float(sample_size[:-1]) * 0.01 * size)
+
+
+def sample_lazy(values, sample_size, remove_missing=True):
+    """
+    Take a random sample of values that are read lazily, reading only the
+    chunks that contain sampled points. Without missing values, points are
+    drawn in random order until enough valid values are found.
+    """
+
+    if sample_size > values.size:
+        logging.warning(f"Grid has only {values.size} elements, cannot generate a sample")
+        return None, None
+
+    # draws in time proportional to the sample, not to the grid
+    rng = np.random.default_rng()
+
+    if not remove_missing:
+        indices = rng.choice(values.size, sample_size, replace=False)
+        return indices, values.take(indices)
+
+    if values.valid_size is not None and values.valid_size < sample_size:
+        logging.warning(
+            "{:.1f}% of grid elements are missing, cannot generate a sample".format(
+                100 * (1 - float(values.valid_size) / values.size)
+            ),
+        )
+        return None, None
+
+    indices, data = draw_valid([values], sample_size)
+
+    if indices is None:
+        return None, None
+
+    logging.debug(f"Read {values.chunks_read} chunks for a sample of {sample_size} values")
+
+    return indices, data[0]
+
+
+def take_values(values, indices):
+    """
+    Return values at indices of a masked array or LazyValues, as a masked
+    array.
+    """
+
+    if isinstance(values, LazyValues):
+        return values.take(indices)
+
+    return np.ma.masked_array(values)[indices]
+
+
+def draw_valid(grids, sample_size):
+    """
+    Draw sample_size random points where none of the grids (masked arrays or
+    LazyValues of the same size) has a missing value. Points are drawn in
+    random order until enough valid points are found, and only the drawn
+    points are read. Returns the indices and the values of each grid at
+    them, or None, None if there are not enough valid points.
+    """
+
+    size = grids[0].size
+    rng = np.random.default_rng()
+
+    indices = []
+    data = [[] for g in grids]
+    found = 0
+    drawn = np.empty(0, dtype=np.int64)
+
+    while found < sample_size and drawn.size < size:
+        # draw more than needed if values have been missing so far
+        needed = sample_size - found
+        if found == 0:
+            count = max(needed, drawn.size)
+        else:
+            count = int(needed * drawn.size / found * 1.2) + 1
+
+        if 2 * count >= size - drawn.size:
+            # most of the grid is drawn anyway: take all points not drawn yet
+            candidates = rng.permutation(np.setdiff1d(np.arange(size), drawn))
+        else:
+            candidates = rng.choice(size, count, replace=False)
+            candidates = candidates[~np.isin(candidates, drawn)]
+
+        drawn = np.concatenate([drawn, candidates])
+
+        samples = [take_values(g, candidates) for g in grids]
+        valid = ~np.logical_or.reduce([np.ma.getmaskarray(s) for s in samples])
+
+        indices.append(candidates[valid])
+        for d, s in zip(data, samples):
+            d.append(np.ma.getdata(s)[valid])
+        found += np.count_nonzero(valid)
+
+    if found < sample_size:
+        logging.warning(
+            "{:.1f}% of grid elements are missing, cannot generate a sample".format(
+                100 * (1 - float(found) / size)
+            ),
+        )
+        return None, None
+
+    return np.concatenate(indices)[:sample_size], [np.concatenate(d)[:sample_size] for d in data]
+
+
+def materialize(grids):
+    """
+    Read values of lazily read grids.
+    """
+
+    for g in grids:
+        if isinstance(g["Values"], LazyValues):
+            if len(g["Values"].shape) == 2:
+                g["Shape"] = g["Values"].shape
+            g["Values"] = g["Values"].read()
 
     return grids
 
 
+def known_valid_size(values):
+    """
+    Number of valid values of a masked array or LazyValues, or None if it is
+    not known without reading the values.
+    """
+
+    if isinstance(values, LazyValues):
+        return values.valid_size
+
+    return values.size - np.ma.count_masked(values)
+
+
+def sample_shared(grids, sample_size):
+    """
+    Sample grids (masked arrays or LazyValues) at the same points, where none
+    of the grids has a missing value. Only the sampled points are read,
+    unless sample size is a percentage of the valid points, at least half of
+    the grid or at least the number of valid points of a grid: then the
+    whole grids are read and the points are drawn from their combined mask. Returns the indices and the values of each grid at
+    them, or None, None if there is no sample. If the sample is all valid
+    points, the values are not copied: indices are None and the values are
+    the grids masked where any of them is missing.
+    """
+
+    size = grids[0].size
+
+    if "%" not in str(sample_size):
+        sample_size = int(sample_size)
+
+        if sample_size > size:
+            logging.warning(f"Grid has only {size} elements, cannot generate a sample")
+            return None, None
+
+        known = [n for n in map(known_valid_size, grids) if n is not None]
+
+        if 2 * sample_size < size and (len(known) == 0 or sample_size < min(known)):
+            return draw_valid(grids, sample_size)
+
+    grids = [g.read() if isinstance(g, LazyValues) else g for g in grids]
+    missing = np.logical_or.reduce([np.ma.getmaskarray(g) for g in grids])
+    valid = size - np.count_nonzero(missing)
+
+    if "%" in str(sample_size):
+        sample_size = int(float(sample_size[:-1]) * 0.01 * valid)
+
+    if sample_size > valid:
+        logging.warning(
+            "{:.1f}% of grid elements are missing, cannot generate a sample".format(
+                100 * (1 - float(valid) / size)
+            ),
+        )
+        return None, None
+
+    if sample_size == valid:
+        return None, [np.ma.masked_array(np.ma.getdata(g), mask=missing) for g in grids]
+
+    rng = np.random.default_rng()
+    indices = rng.choice(np.flatnonzero(~missing), sample_size, replace=False)
+
+    return indices, [np.ma.getdata(g)[indices] for g in grids]
+
+
+def read_temporal_sample(grids, sample_size):
+    """
+    Sample each grid together with the grid of the previous leadtime, at the
+    same indices. The previous values are stored in key "Previous", which is
+    None if there is no previous leadtime.
+    """
+
+    previous = {
+        g["Parameter"][: -len(PREVIOUS_SUFFIX)]: g
+        for g in grids
+        if g["Parameter"].endswith(PREVIOUS_SUFFIX)
+    }
+
+    samples = []
+
+    for g in grids:
+        if g["Parameter"].endswith(PREVIOUS_SUFFIX):
+            continue
+
+        prev = previous.get(g["Parameter"])
+
+        if prev is None:
+            samples.append({**g, "Indices": None, "Values": np.empty(0), "Previous": None})
+            continue
+
+        indices, values = sample_shared([g["Values"], prev["Values"]], sample_size)
+
+        if values is None:
+            samples.append(None)
+            continue
+
+        samples.append({**g, "Indices": indices, "Values": values[0], "Previous": values[1]})
+
+    return samples
+
+
+def read_shared_sample(grids, sample_size):
+    """
+    Sample all grids at the same indices, picked so that none of the grids
+    has a missing value there. Returns one sample, where "Values" is a dict
+    of the sampled values of each parameter.
+    """
+
+    if len(grids) == 0:
+        return []
+
+    if len(set(g["Values"].size for g in grids)) > 1:
+        logging.warning("Grids have different sizes, cannot generate a shared sample")
+        return [None]
+
+    indices, values = sample_shared([g["Values"] for g in grids], sample_size)
+
+    if values is None:
+        return [None]
+
+    return [
+        {
+            **grids[0],
+            "Parameter": ", ".join(g["Parameter"] for g in grids),
+            "Indices": indices,
+            "Values": {g["Parameter"]: v for g, v in zip(grids, values)},
+        }
+    ]
+
+
+def read_ensemble_sample(index, keys, cache, sample_size):
+    """
+    Sample the members of an ensemble at the same points, reading one member
+    at a time and accumulating the count, mean and sum of squared
+    differences of each point (see tests.member_moments), so that only the
+    accumulated statistics of the sample are kept between members.
+
+    Points are sampled from the first member, and a member that is missing
+    a point does not count for it. Member reads are not announced to the
+    cache: members are not kept for the ensemble, but read again if other
+    tests have already used them. Returns one sample for each parameter,
+    where "Values" is the accumulated (count, mean, m2) and "Members" the
+    number of members read.
+    """
+
+    members = {}
+    for param, key in keys:
+        members.setdefault(param, []).append(key)
+
+    samples = []
+
+    for param, member_keys in members.items():
+        sample = None
+        state = None
+
+        for key in member_keys:
+            grids = read_grids(index, ((param, key),), cache, expected=False)
+
+            if len(grids) == 0:
+                continue
+
+            g = grids[param]
+
+            if sample is None:
+                first = read_sample([{"Values": g["Values"]}], sample_size)[0]
+
+                if first["Values"] is None:
+                    # no sample, the remaining members are not needed
+                    break
+
+                sample = {
+                    **g,
+                    "Parameter": param,
+                    "Indices": first["Indices"],
+                    "Members": 0,
+                }
+                size = g["Values"].size
+                values = first["Values"]
+            elif g["Values"].size != size:
+                logging.warning(f"Ensemble members of '{param}' have different sizes, member skipped")
+                continue
+            elif sample["Indices"] is None:
+                values = materialize([g])[0]["Values"]
+            elif isinstance(g["Values"], LazyValues):
+                values = g["Values"].take(sample["Indices"])
+            else:
+                values = np.ma.masked_array(g["Values"])[sample["Indices"]]
+
+            state = member_moments(state, values)
+            sample["Members"] += 1
+
+        if sample is not None:
+            sample["Values"] = state
+            sample.pop("Shape", None)
+            sample.pop("Order", None)
+
+        samples.append(sample)
+
+    return samples
+
+
+def read_fields(grids):
+    """
+    Use whole grids as samples, for tests that need the 2-D layout of the
+    grid. Grids whose shape is not known are skipped.
+    """
+
+    samples = []
+
+    for g in grids:
+        if g.get("Shape") is None:
+            logging.warning(f"Grid shape of '{g['Parameter']}' is not known, cannot run a spatial test")
+            samples.append(None)
+            continue
+
+        samples.append({**g, "Indices": None})
+
+    return samples
+
+
 def string_to_timedelta(string):
     if string[-1] == "h":
         return timedelta(hours=int(string[:-1]))
@@ -110,12 +559,6 @@ def string_to_timedelta(string):
     return timedelta(hours=int(t[0]), minutes=int(t[1]), seconds=int(t[2]))
 
 
-def timedelta_to_grib2metadata(td):
-    d = {"Grib2MetaData": [{"Key": "endStep", "Value": int(td.total_seconds() / 3600)}]}
-
-    return d
-
-
 def generate_leadtimes(leadtime_configs):
     leadtimes = []
     for cfg in leadtime_configs:
@@ -131,14 +574,6 @@ def generate_leadtimes(leadtime_configs):
     return leadtimes
 
 
-def format_metadata_to_string(metadata):
-    string = ""
-    for m in metadata:
-        string += "%s=%s " % (m["Key"], m["Value"])
-
-    return string
-
-
 def preprocess(grids, test):
     """
     Preprocess grids before running the test.
@@ -160,7 +595,7 @@ def preprocess(grids, test):
 
         lcl = locals()
 
-        for g in grids:
+        for g in materialize(grids):
             lcl[g["Parameter"]] = g["Values"]
 
         processed = eval(prep["Function"])
@@ -179,7 +614,12 @@ def preprocess(grids, test):
         raise Exception("Invalid preprocessing function: {prep}: {e}")
 
 
-def execute_single_test(test, forecast_types, leadtimes, parameters, files):
+def test_class(test):
+    """
+    Return the class implementing the test, and a flag telling if missing
+    values should be removed from the sample.
+    """
+
     ty = test["Test"]["Type"]
 
     remove_missing = True
@@ -196,76 +636,479 @@ def execute_single_test(test, forecast_types, leadtimes, parameters, files):
         classname = MissingTest
     elif ty == "INTEGER":
         classname = IntegerTest
+    elif ty == "CLIMATOLOGY":
+        classname = ClimatologyTest
+    elif ty == "MONOTONIC":
+        classname = MonotonicTest
+    elif ty == "PERCENTILE":
+        classname = PercentileTest
+    elif ty == "HISTOGRAM":
+        classname = HistogramTest
+    elif ty == "CONSISTENCY":
+        classname = ConsistencyTest
+    elif ty == "SPIKE":
+        classname = SpikeTest
+    elif ty == "GRADIENT":
+        classname = GradientTest
+    elif ty == "ENSEMBLE_SPREAD":
+        classname = EnsembleSpreadTest
     else:
         raise TestNotImplementedException("Unsupported test: {}".format(test["Test"]))
 
-    ret = {"success": 0, "fail": 0, "skip": 0, "summary": []}
+    return classname, remove_missing
+
+
+def ensemble_forecast_type(forecast_types):
+    """
+    Combine forecast types of ensemble members into one, for reporting.
+    Metadata values that differ between members are listed, and member
+    numbers are given as a range.
+    """
+
+    metadata = []
+
+    for item in forecast_types[0]["Grib2MetaData"]:
+        values = []
+        for ft in forecast_types:
+            for kv in ft["Grib2MetaData"]:
+                if kv["Key"] == item["Key"] and kv["Value"] not in values:
+                    values.append(kv["Value"])
+
+        if len(values) == 1:
+            value = values[0]
+        elif item["Key"] == "perturbationNumber" and None not in values:
+            value = f"{min(values)}-{max(values)}"
+        else:
+            value = ",".join(str(v) for v in values)
+
+        metadata.append({"Key": item["Key"], "Value": value})
+
+    return {"Grib2MetaData": metadata}
+
+
+def compile_units(parameters, forecast_types, leadtimes, previous=False, ensemble=False):
+    """
+    Compile test parameters into index keys for each forecast type and
+    leadtime combination, with lag already applied to lagged parameters.
+
+    If previous is set, keys of the previous leadtime are also included for
+    each parameter, with PREVIOUS_SUFFIX appended to parameter name.
+
+    If ensemble is set, forecast types are the members of an ensemble, and
+    there is one unit for each leadtime, with the keys of all members. The
+    same parameter name is then repeated for each member.
+
+    Returns a list of (forecast type, leadtime, keys) tuples, where keys is a
+    tuple of (parameter name, index key) pairs.
+    """
+
+    endstep = KEY_POSITION["endStep"]
+
+    bases = []
+    for param, v in parameters.items():
+        lag = string_to_timedelta(v["Lag"]) if "Lag" in v else None
+        bases.append((param, conditions_to_key(v["Grib2MetaData"]), lag))
+
+    units = []
 
     for ft in forecast_types:
-        lparameters = inject(copy.deepcopy(parameters), ft)
+        ft_values = [
+            (KEY_POSITION[item["Key"]], item["Value"])
+            for item in ft["Grib2MetaData"]
+            if item["Key"] in KEY_POSITION
+        ]
+
+        ft_bases = []
+        for param, base, lag in bases:
+            key = list(base)
+            for pos, value in ft_values:
+                key[pos] = value
+            ft_bases.append((param, key, lag))
+
+        def keys_at(lt, suffix=""):
+            step = int(lt.total_seconds() / 3600)
+            keys = []
+
+            for param, key, lag in ft_bases:
+                if lag is None:
+                    key[endstep] = step
+                else:
+                    key[endstep] = int((timedelta(hours=step) - lag).total_seconds() / 3600)
+                keys.append((param + suffix, tuple(key)))
+
+            return keys
+
+        prev = None
         for lt in leadtimes:
-            lparameters = inject(lparameters, timedelta_to_grib2metadata(lt))
-            grids = read_grids(files, lparameters)
-            grids = [{"Parameter": x, **grids[x]} for x in grids.keys()]
-
-            samples = read_sample(
-                preprocess(grids, test),
-                test["Sample"],
-                remove_missing=remove_missing,
-            )
+            keys = keys_at(lt)
 
-            if len(samples) == 0:
-                ret["skip"] += 1
-                continue
+            if previous and prev is not None:
+                keys += keys_at(prev, PREVIOUS_SUFFIX)
 
-            for sample in samples:
-                if sample is None or sample["Values"] is None:
-                    ret["skip"] += 1
+            units.append((ft, lt, tuple(keys)))
+            prev = lt
 
-                    continue
+    if ensemble:
+        ft = ensemble_forecast_type(forecast_types)
+        units = [
+            (ft, lt, tuple(key for _, ult, keys in units if ult == lt for key in keys))
+            for lt in leadtimes
+        ]
+
+    return units
+
+
+def compile_plans(config, dims):
+    """
+    Compile configured tests into execution plans. Returns a list of
+    (single test, units) pairs, see compile_units().
+    """
+
+    plans = []
 
-                parameter = sample["Parameter"]
-                status = classname(test)(sample)
-                return_code = status["return_code"]
-
-                if return_code == 0:
-                    ret["success"] += 1
-                elif return_code == 1:
-                    ret["fail"] += 1
-
-                message = ""
-
-                for kv in ft["Grib2MetaData"]:
-                    if kv["Key"] == "typeOfProcessedData":
-                        if str(kv["Value"]) != "2":
-                            message = f"Forecast type: {format_metadata_to_string(ft['Grib2MetaData'])}"
-                        break
-
-                message += "{} for {} +{:.0f}h ({}): {}".format(
-                    parameter,
-                    sample["AnalysisTime"],
-                    lt.total_seconds() / 3600,
-                    sample["ForecastTime"],
-                    status["message"],
+    for test in config["Tests"]:
+        parameters = tie(test["Parameters"], dims["parameters"])
+        units = {}
+
+        for single_test in single_tests(test):
+            classname, remove_missing = test_class(single_test)
+            previous = getattr(classname, "temporal", False)
+            ensemble = getattr(classname, "ensemble", False)
+
+            # only tests of plain samples are run on preprocessed grids
+            if ("Preprocess" in single_test or "Preprocess" in single_test["Test"]) and any(
+                getattr(classname, flag, False) for flag in SAMPLE_FLAGS
+            ):
+                raise ValueError(
+                    f"Preprocess cannot be used with {single_test['Test']['Type']} test "
+                    f"'{single_test.get('Name')}'"
                 )
 
-                ret["summary"].append(
-                    {
-                        "name": status["name"],
-                        "return_value": return_code,
-                        "message": message,
-                    }
+            if (previous, ensemble) not in units:
+                units[(previous, ensemble)] = compile_units(
+                    parameters,
+                    dims["forecast_types"],
+                    dims["leadtimes"],
+                    previous,
+                    ensemble,
                 )
 
+            plans.append((single_test, units[(previous, ensemble)]))
+
+    return plans
+
+
+def evaluate_unit(test, classname, remove_missing, ft, lt, grids, ret, orders=None):
+    """
+    Run test for grids of one forecast type and leadtime, and add the
+    outcome to results in 'ret'. Samples are taken from orders if given,
+    see SampleOrders.
+    """
+
+    grids = [{"Parameter": x, **grids[x]} for x in grids.keys()]
+
+    if getattr(classname, "temporal", False):
+        samples = read_temporal_sample(grids, test["Sample"]) if len(grids) > 0 else []
+    elif getattr(classname, "spatial", False):
+        samples = read_fields(materialize(grids))
+    elif getattr(classname, "shared", False):
+        samples = read_shared_sample(grids, test["Sample"])
+    else:
+        samples = read_sample(
+            preprocess(grids, test),
+            test["Sample"],
+            remove_missing=remove_missing,
+            orders=orders,
+        )
+
+    if len(samples) == 0:
+        ret["skip"] += 1
+        return
+
+    for sample in samples:
+        if sample is None or sample["Values"] is None:
+            ret["skip"] += 1
+
+            continue
+
+        add_status(ret, classname(test)(sample), sample, ft, lt)
+
+
+def evaluate_ensemble_unit(test, classname, ft, lt, index, keys, cache, ret):
+    """
+    Run test for the members of an ensemble at one leadtime, and add the
+    outcome to results in 'ret'.
+    """
+
+    samples = read_ensemble_sample(index, keys, cache, test["Sample"])
+
+    for sample in samples:
+        if sample is None:
+            ret["skip"] += 1
+            continue
+
+        add_status(ret, classname(test)(sample), sample, ft, lt)
+
+
+def add_status(ret, status, sample, ft, lt):
+    """
+    Add the outcome of a test for one sample to results in 'ret'.
+    """
+
+    parameter = sample["Parameter"]
+    return_code = status["return_code"]
+
+    if return_code == 0:
+        ret["success"] += 1
+    elif return_code == 1:
+        ret["fail"] += 1
+
+    forecast_type = None
+
+    for kv in ft["Grib2MetaData"]:
+        if kv["Key"] == "typeOfProcessedData":
+            if str(kv["Value"]) != "2":
+                forecast_type = ft["Grib2MetaData"]
+            break
+
+    # message is formatted only when it is used
+    ret["summary"].append(
+        Summary(
+            status["name"],
+            return_code,
+            status["message"],
+            parameter,
+            sample["AnalysisTime"],
+            sample["ForecastTime"],
+            lt,
+            forecast_type,
+        )
+    )
+
+
+def header_statuses(test, classname, index, keys, cache):
+    """
+    Evaluate test for the grids of one unit from grib headers only. Returns
+    the status and sample of each grid, or None if the test cannot be
+    decided from the headers of all grids.
+    """
+
+    if not hasattr(classname, "from_header") or getattr(classname, "temporal", False):
+        return None
+
+    if "Preprocess" in test or "Preprocess" in test["Test"]:
+        return None
+
+    if any(index.get(key) is None for param, key in keys):
+        return None
+
+    statuses = []
+
+    for param, key in keys:
+        header = cache.read_header(key, index[key])
+        status = classname(test).from_header(header)
+
+        if status is None:
+            return None
+
+        statuses.append((status, {"Parameter": param, **header}))
+
+    return statuses
+
+
+def evaluate_unit_from_headers(test, classname, ft, lt, index, keys, cache, ret):
+    """
+    Try to run test for one forecast type and leadtime from grib headers
+    only, without decoding data values. Returns False if the test cannot be
+    decided from the headers of all grids, and the grids must be decoded.
+    """
+
+    statuses = header_statuses(test, classname, index, keys, cache)
+
+    if statuses is None:
+        return False
+
+    for param, key in keys:
+        cache.release(key)
+
+    for status, sample in statuses:
+        add_status(ret, status, sample, ft, lt)
+
+    return True
+
+
+def merge_results(results):
+    """
+    Combine results of several units of a single test, in the given order.
+    """
+
+    ret = {"success": 0, "fail": 0, "skip": 0, "summary": []}
+
+    for r in results:
+        ret["success"] += r["success"]
+        ret["fail"] += r["fail"]
+        ret["skip"] += r["skip"]
+        ret["summary"].extend(r["summary"])
+
     return ret
 
 
-def execute_test(test, forecast_types, leadtimes, parameters, files):
+def assign_shards(all_plans, count):
+    """
+    Assign the units of all plans to count shards. Units of the same forecast
+    type and leadtime go to the same shard, and the groups are ordered by
+    leadtime and split to shards in contiguous ranges of about equal numbers
+    of units. A shard then gets whole leadtimes when there are more of them
+    than shards, so that the grids of the previous or lagged leadtime and
+    the members of an ensemble are mostly in the same shard, and a grid is
+    decoded in as few shards as possible. The assignment depends only on the
+    plans, so that independent processes compiling the same configurations
+    agree on it.
+
+    Returns a dict of shard number by (configuration, test, unit) position.
+    """
+
+    groups = {}
+    ft_order = {}
+    total = 0
+
+    for c, plans in enumerate(all_plans):
+        for p, (test, units) in enumerate(plans):
+            for u, (ft, lt, keys) in enumerate(units):
+                ftk = ft_order.setdefault(
+                    format_metadata_to_string(ft["Grib2MetaData"]), len(ft_order)
+                )
+                groups.setdefault((lt, ftk), []).append((c, p, u))
+                total += 1
+
+    shards = {}
+    assigned = 0
+
+    for group in sorted(groups):
+        shard = min(count - 1, assigned * count // total)
+
+        for pos in groups[group]:
+            shards[pos] = shard
+
+        assigned += len(groups[group])
+
+    return shards
+
+
+def execute_units(all_plans, index, cache=None, selected=None, orders=None):
+    """
+    Execute the plans of one or more configurations against a shared index.
+
+    Units of all plans are executed ordered by forecast type and leadtime, so
+    that units reading the same grids run close to each other, and each grid
+    is decoded only once and dropped soon after its last use. Tests that can
+    be decided from grib headers are run without decoding. Returns the
+    results of each unit of each single test, for each configuration.
+
+    If selected is given, only units at those (configuration, test, unit)
+    positions are executed, and the results of other units are None. If
+    orders (SampleOrders) is given, samples are taken from its orders.
+    """
+
+    if cache is None:
+        cache = GridCache()
+
+    decoded, reused, avoided = cache.decoded, cache.reused, cache.avoided
+    classes = []
+    work = []
+    ft_order = {}
+
+    for c, plans in enumerate(all_plans):
+        classes.append([test_class(test) for test, units in plans])
+
+        for p, (test, units) in enumerate(plans):
+            for u, (ft, lt, keys) in enumerate(units):
+                if selected is not None and (c, p, u) not in selected:
+                    continue
+
+                ftk = ft_order.setdefault(
+                    format_metadata_to_string(ft["Grib2MetaData"]), len(ft_order)
+                )
+                work.append((ftk, lt, c, p, u))
+
+                # members are read one at a time for an ensemble, holding
+                # them until the ensemble is evaluated would keep all of them
+                # in memory
+                if not getattr(classes[c][p][0], "ensemble", False):
+                    cache.expect(key for param, key in keys)
+
+    work.sort()
+
+    results = [[[None] * len(units) for test, units in plans] for plans in all_plans]
+
+    # with a decode pool, grids of the next units are decoded while the
+    # current unit is evaluated. Grids of tests that are decided from the
+    # headers are not prefetched, nor ensembles, which are read one member
+    # at a time. Headers are kept by the cache, so they are read only once.
+    window = 0 if cache.pool is None else 2 * cache.pool.workers
+
+    for i, (ftk, lt, c, p, u) in enumerate(work):
+        for _, _, nc, np_, nu in work[i : i + window]:
+            if getattr(classes[nc][np_][0], "ensemble", False):
+                continue
+
+            test, units = all_plans[nc][np_]
+
+            if header_statuses(test, classes[nc][np_][0], index, units[nu][2], cache) is not None:
+                continue
+
+            for param, key in units[nu][2]:
+                if key in index:
+                    cache.prefetch(key, index[key])
+
+        test, units = all_plans[c][p]
+        ft, lt, keys = units[u]
+        classname, remove_missing = classes[c][p]
+
+        ret = {"success": 0, "fail": 0, "skip": 0, "summary": []}
+        results[c][p][u] = ret
+
+        if evaluate_unit_from_headers(test, classname, ft, lt, index, keys, cache, ret):
+            continue
+
+        if getattr(classname, "ensemble", False):
+            evaluate_ensemble_unit(test, classname, ft, lt, index, keys, cache, ret)
+            continue
+
+        grids = read_grids(index, keys, cache)
+        evaluate_unit(test, classname, remove_missing, ft, lt, grids, ret, orders)
+
+    logging.debug(
+        f"Decoded {cache.decoded - decoded} grids, reused {cache.reused - reused} decoded grids, at most {cache.peak} grids in memory"
+    )
+    logging.debug(
+        f"Decoding of {cache.avoided - avoided} grids avoided by evaluating tests from grib headers"
+    )
+
+    return results
+
+
+def execute_plans(all_plans, index, cache=None, orders=None):
+    """
+    Execute the plans of one or more configurations, see execute_units().
+    Returns the results of each single test, for each configuration.
+    """
+
+    results = execute_units(all_plans, index, cache, orders=orders)
+
+    return [[merge_results(r) for r in config_results] for config_results in results]
+
+
+def single_tests(test):
+    """
+    Split a test configuration into single tests.
+    """
+
     if type(test["Test"]) is dict:
         # single test
-        return [execute_single_test(test, forecast_types, leadtimes, parameters, files)]
+        return [test]
 
-    results = []
+    tests = []
     for t in test["Test"]:
         # Since the actual test needs other information also than just the test
         # parameters, like sample size, we need to make a copy of test and inject
@@ -274,41 +1117,9 @@ def execute_test(test, forecast_types, leadtimes, parameters, files):
         # override the list with the actual test we are running.
         fake_test = copy.deepcopy(test)
         fake_test["Test"] = t
-        results.append(
-            execute_single_test(fake_test, forecast_types, leadtimes, parameters, files)
-        )
+        tests.append(fake_test)
 
-    return results
-
-
-def inject(conditions, injected):
-    if "Grib2MetaData" in injected:
-        injected = injected["Grib2MetaData"]
-
-    for inj in injected:
-        for k, v in conditions.items():
-            g2meta = v["Grib2MetaData"]
-            for item in g2meta:
-                if inj["Key"] == item["Key"]:
-                    # if injecting time, check if parameter is lagged
-                    if inj["Key"] == "endStep" and "Lag" in v:
-                        lagged = int(
-                            (
-                                timedelta(hours=inj["Value"])
-                                - string_to_timedelta(v["Lag"])
-                            ).total_seconds()
-                            / 3600
-                        )
-                        #                        logging.debug(f"Lagging time {inj['Value']} to {lagged}")
-                        item["Value"] = lagged
-                    else:
-                        item["Value"] = inj["Value"]
-                    found = True
-                    break
-            if not found:
-                g2meta["Key"] = inj["Value"]
-
-    return conditions
+    return tests
 
 
 def tie(req_parameters, parameters):
@@ -373,72 +1184,283 @@ def tie(req_parameters, parameters):
     return ret
 
 
-def check(config, dims, files, strict=False):
-    all_success = 0
-    all_fail = 0
-    all_skip = 0
-
-    return_code = 0
-    combined_errors = []
-
-    def handle_result(summaries):
-        success = summaries["success"]
-        fail = summaries["fail"]
-        skip = summaries["skip"]
-
-        if len(summaries["summary"]) == 0:
-            logging.info("No grids checked")
-            retval = 1
-
-        for summary in summaries["summary"]:
-            retval = summary["return_value"]
-            if retval == 0:
-                # test was successful
-                logging.info(summary["message"])
-            elif retval == -1:
-                # test was skipped with ok status, for example month didn't match
-                # log with debug level as it was not a failure and produces a lot of output
-                logging.debug(summary["message"])
-            elif retval == 1:
-                # test failed
-                logging.error(summary["message"])
-                combined_errors.append(
-                    {"name": summary["name"], "message": summary["message"]}
-                )
+def compile_demand(config, dims, plans=None):
+    """
+    Return the set of index keys of all grib messages that the configured
+    tests need. Used to prune the index to only those messages.
+    """
 
-        return success, fail, skip, retval
+    if plans is None:
+        plans = compile_plans(config, dims)
 
-    for test in config["Tests"]:
-        all_summaries = execute_test(
-            test,
-            dims["forecast_types"],
-            dims["leadtimes"],
-            tie(test["Parameters"], dims["parameters"]),
-            files,
-        )
+    demand = set()
+
+    for test, units in plans:
+        for ft, lt, keys in units:
+            demand.update(key for param, key in keys)
+
+    return demand
 
-        for summaries in all_summaries:
-            success, fail, skip, retval = handle_result(summaries)
-            all_success += success
-            all_fail += fail
-            all_skip += skip
 
-            if retval > return_code:
-                return_code = retval
+def check(config, dims, files, strict=False, plans=None, pool=None):
+    if plans is None:
+        plans = compile_plans(config, dims)
 
-    logging.info(
-        f"Total Summary: successful tests: {all_success}, failed: {all_fail}, skipped: {all_skip}"
+    results = execute_plans([plans], files, GridCache(pool=pool))[0]
+
+    return report(results, strict)["return_code"]
+
+
+def check_batch(configurations, files, strict=False, index_files=None, pool=None):
+    """
+    Check several configurations against the same files. The configurations
+    share one index and one pass of decoded grids.
+
+    configurations is a list of (name, config, dims) tuples. Results are
+    reported separately for each configuration, and a dict of exit codes by
+    configuration name is returned. If a decode pool is given, grids are
+    decoded in its worker processes.
+    """
+
+    all_plans = [compile_plans(config, dims) for name, config, dims in configurations]
+
+    demand = set()
+    for (name, config, dims), plans in zip(configurations, all_plans):
+        demand.update(compile_demand(config, dims, plans))
+
+    all_results = execute_plans(
+        all_plans, index_grib_files(files, demand, index_files), GridCache(pool=pool)
+    )
+
+    return report_batch(
+        [(name, results) for (name, config, dims), results in zip(configurations, all_results)],
+        strict,
+    )
+
+
+def check_shard(configurations, files, shard, count, index_files=None, pool=None):
+    """
+    Check one shard of the work of several configurations, for running a
+    check in pieces on independent nodes or processes. Only the messages
+    needed by the units of this shard are indexed and read.
+
+    configurations is a list of (name, config, dims) tuples. Returns the
+    partial results, to be combined with the partial results of the other
+    shards with merge_shards().
+    """
+
+    all_plans = [compile_plans(config, dims) for name, config, dims in configurations]
+
+    selected = set(
+        pos for pos, s in assign_shards(all_plans, count).items() if s == shard
+    )
+
+    demand = set()
+    for c, p, u in selected:
+        ft, lt, keys = all_plans[c][p][1][u]
+        demand.update(key for param, key in keys)
+
+    logging.info(f"Shard {shard}/{count}: {len(selected)} units")
+
+    all_results = execute_units(
+        all_plans,
+        index_grib_files(files, demand, index_files),
+        GridCache(pool=pool),
+        selected=selected,
     )
 
-    if len(combined_errors) > 0:
-        logging.error("Summary of errors:")
-        for err in combined_errors:
-            logging.error("'{}': {}".format(err["name"], err["message"]))
+    return {
+        "shard": shard,
+        "count": count,
+        "configurations": [
+            {"name": name, "results": results}
+            for (name, config, dims), results in zip(configurations, all_results)
+        ],
+    }
+
+
+def merge_shards(partials):
+    """
+    Combine the partial results of all shards of a check. Returns the results
+    of each single test as (name, results) tuples, one for each
+    configuration, in the same order as an unsharded check would give.
+    """
+
+    if len(partials) == 0:
+        raise ValueError("No partial results to merge")
+
+    count = partials[0]["count"]
+    shards = sorted(p["shard"] for p in partials)
+
+    if any(p["count"] != count for p in partials) or shards != list(range(count)):
+        raise ValueError(
+            f"Partial results do not cover all shards: got shards {shards} of {count}"
+        )
+
+    names = [c["name"] for c in partials[0]["configurations"]]
+
+    if any([c["name"] for c in p["configurations"]] != names for p in partials):
+        raise ValueError("Partial results are from different configurations")
+
+    merged = []
+
+    for c, name in enumerate(names):
+        tests = []
+
+        for t, units in enumerate(partials[0]["configurations"][c]["results"]):
+            unit_results = []
+
+            for u in range(len(units)):
+                found = [
+                    p["configurations"][c]["results"][t][u]
+                    for p in partials
+                    if p["configurations"][c]["results"][t][u] is not None
+                ]
+
+                if len(found) != 1:
+                    raise ValueError(
+                        f"Unit {u} of test {t} of configuration {name} found in {len(found)} shards"
+                    )
+
+                unit_results.append(found[0])
+
+            tests.append(merge_results(unit_results))
+
+        merged.append((name, tests))
+
+    return merged
+
+
+def check_stream(config, dims, stream, strict=False, plans=None, pool=None):
+    """
+    Check grib messages read from a non-seekable stream, like stdin or a pipe.
+
+    Messages are parsed as they arrive. A message is kept in memory only if
+    a pending test unit (one forecast type and leadtime of a test) needs it,
+    and a unit is evaluated as soon as all of its input messages have been
+    read. After that the messages it used are dropped, unless another pending
+    unit still needs them.
+
+    Ensemble units with members missing from the stream are evaluated with
+    the members that were found when the stream ends, and other incomplete
+    units are skipped. Results are reported in the order of the units of
+    each test, like check() does, whatever the order of the messages.
+    """
+
+    if plans is None:
+        plans = compile_plans(config, dims)
+
+    plan_units = []
+    units = []
+    cache = GridCache(pool=pool)
+
+    # which pending units are waiting for a message
+    waiting = {}
+
+    for test, test_units in plans:
+        classname, remove_missing = test_class(test)
+        plan_units.append([])
+
+        for ft, lt, keys in test_units:
+            if not getattr(classname, "ensemble", False):
+                cache.expect(key for param, key in keys)
+
+            unit = {
+                "test": test,
+                "classname": classname,
+                "remove_missing": remove_missing,
+                "ft": ft,
+                "lt": lt,
+                "keys": keys,
+                "missing": set(key for param, key in keys),
+                "ret": {"success": 0, "fail": 0, "skip": 0, "summary": []},
+            }
+            units.append(unit)
+            plan_units[-1].append(unit)
+
+            for key in unit["missing"]:
+                waiting.setdefault(key, []).append(unit)
+
+    # number of pending units using a message
+    refs = {key: len(waiting[key]) for key in waiting}
+    messages = {}
+    cnt = 0
+
+    for message in read_grib_stream(stream):
+        key = message_key(message)
+        cnt += 1
+
+        if key not in waiting or key in messages:
+            continue
+
+        messages[key] = {"message": message}
+
+        for unit in waiting.pop(key):
+            unit["missing"].discard(key)
+
+            if len(unit["missing"]) > 0:
+                continue
+
+            if getattr(unit["classname"], "ensemble", False):
+                evaluate_ensemble_unit(
+                    unit["test"],
+                    unit["classname"],
+                    unit["ft"],
+                    unit["lt"],
+                    messages,
+                    unit["keys"],
+                    cache,
+                    unit["ret"],
+                )
+            else:
+                grids = read_grids(messages, unit["keys"], cache)
+
+                evaluate_unit(
+                    unit["test"],
+                    unit["classname"],
+                    unit["remove_missing"],
+                    unit["ft"],
+                    unit["lt"],
+                    grids,
+                    unit["ret"],
+                )
+
+            for pkey in set(pkey for param, pkey in unit["keys"]):
+                refs[pkey] -= 1
+                if refs[pkey] == 0:
+                    messages.pop(pkey)
+
+    logging.info(f"Read {cnt} messages from stream")
+
+    for unit in units:
+        if len(unit["missing"]) == 0:
+            continue
+
+        if getattr(unit["classname"], "ensemble", False):
+            # messages of the unit are kept, as it was never evaluated
+            evaluate_ensemble_unit(
+                unit["test"],
+                unit["classname"],
+                unit["ft"],
+                unit["lt"],
+                messages,
+                unit["keys"],
+                cache,
+                unit["ret"],
+            )
+            continue
 
-    if strict and (all_fail > 0 or all_skip > 0):
-        return_code = 1
+        for param, key in unit["keys"]:
+            if key in unit["missing"]:
+                logging.warning(
+                    f"Unable to find data for '{param}': {format_key_to_string(key)}"
+                )
+            cache.release(key)
+        unit["ret"]["skip"] += 1
 
-    return return_code
+    results = [merge_results([unit["ret"] for unit in u]) for u in plan_units]
+
+    return report(results, strict)["return_code"]
 
 
 def parse_forecast_types(config):
@@ -493,6 +1515,9 @@ def parse_parameters(config):
 
 
 def apply_patch_to_configuration(config, patches):
+    # pydash is only needed for patches
+    import pydash
+
     for patch in patches:
         (k, v) = patch.split("=")
         element = pydash.get(config, k)
@@ -518,7 +1543,119 @@ def apply_patch_to_configuration(config, patches):
     return config
 
 
-def parse_configuration_file(configuration_file, patch):
+def file_digest(path):
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def configuration_cache_file(cache_dir, configuration_file, patch):
+    """
+    Return path of the cached configuration for a configuration file and
+    patches. Includes are resolved relative to the working directory, so it
+    is part of the key too.
+    """
+
+    key = repr((os.path.abspath(configuration_file), os.getcwd(), patch))
+
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".pickle")
+
+
+def owned_privately(path):
+    """
+    Return true if path is owned by the current user and cannot be written
+    by others.
+    """
+
+    st = os.stat(path)
+
+    return st.st_uid == os.getuid() and st.st_mode & 0o022 == 0
+
+
+def read_cached_configuration(cache_file):
+    """
+    Return a cached configuration, or None if it is not cached or any of the
+    files it was parsed from has changed since.
+
+    Cached configurations are pickled, and unpickling runs code, so a cache
+    file is used only if it and its directory are owned by the current user
+    and cannot be written by others.
+    """
+
+    try:
+        if not owned_privately(os.path.dirname(cache_file)) or not owned_privately(
+            cache_file
+        ):
+            logging.warning(
+                f"Cached configuration {cache_file} is writable by other users, not used"
+            )
+            return None
+
+        with open(cache_file, "rb") as fp:
+            entry = pickle.load(fp)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Unable to read cached configuration {cache_file}: {e}")
+        return None
+
+    for path, digest in entry["files"]:
+        if not os.path.exists(path) or file_digest(path) != digest:
+            return None
+
+    for path in entry["absent"]:
+        # a new file would take precedence over the one included
+        if os.path.exists(path):
+            return None
+
+    return entry["configuration"]
+
+
+def write_cached_configuration(cache_file, files, absent, configuration):
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}"
+
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as fp:
+            pickle.dump(
+                {
+                    "files": files,
+                    "absent": absent,
+                    "configuration": configuration,
+                },
+                fp,
+            )
+
+        # concurrent runs see either the old or the new file
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.warning(f"Unable to cache configuration to {cache_file}: {e}")
+
+
+def parse_configuration_file(configuration_file, patch, cache_dir=None):
+    """
+    Parse a configuration file, apply patches, and return the configuration
+    with its forecast types, leadtimes and parameters.
+
+    If cache_dir is given, the result is cached there, and reused as long
+    as the configuration file and all included files are unchanged. The
+    directory is created accessible only by the current user.
+    """
+
+    cache_file = None
+
+    if cache_dir is not None:
+        cache_file = configuration_cache_file(cache_dir, configuration_file, patch)
+        cached = read_cached_configuration(cache_file)
+
+        if cached is not None:
+            logging.debug(f"Using cached configuration {cache_file}")
+            return cached
+
+    # files the configuration is parsed from, and include paths that were
+    # tried but did not exist
+    files = [(os.path.abspath(configuration_file), file_digest(configuration_file))]
+    absent = []
+
     def include_constructor(loader, node):
         # Get the path of the included file
         included_file_path = loader.construct_scalar(node)
@@ -536,6 +1673,7 @@ def parse_configuration_file(configuration_file, patch):
         new_included_file_path = None
         for included_file_path in possible_paths:
             if not os.path.exists(included_file_path):
+                absent.append(os.path.abspath(included_file_path))
                 continue
 
             logging.debug(f"Found included file: {included_file_path}")
@@ -549,6 +1687,7 @@ def parse_configuration_file(configuration_file, patch):
             )
 
         included_file_path = new_included_file_path
+        files.append((os.path.abspath(included_file_path), file_digest(included_file_path)))
 
         # Load the included file
         with open(included_file_path, "r") as included_file:
@@ -590,10 +1729,17 @@ def parse_configuration_file(configuration_file, patch):
     if patch is not None:
         config = apply_patch_to_configuration(config, patch)
 
-    logging.info(yaml.dump(config, default_flow_style=False))
-    return (
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(yaml.dump(config, default_flow_style=False))
+
+    ret = (
         config,
         parse_forecast_types(config),
         parse_leadtimes(config),
         parse_parameters(config),
     )
+
+    if cache_file is not None:
+        write_cached_configuration(cache_file, files, absent, ret)
+
+    return ret
@@ -0,0 +1,83 @@
+import http.client
+import ipaddress
+import json
+import os
+import socket
+
+# The check service and its client. The client is kept free of the heavy
+# modules of the package, so that sending a check to the service starts
+# fast.
+
+
+class CheckRequestError(Exception):
+    pass
+
+
+def parse_address(address):
+    """
+    Parse server address: either 'unix:<path>' for a unix socket, or
+    '[host]:port' for a tcp socket. Host defaults to localhost.
+    """
+
+    if address.startswith("unix:"):
+        return address[5:]
+
+    host, _, port = address.rpartition(":")
+
+    if host == "":
+        host = "127.0.0.1"
+
+    return (host, int(port))
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request_check(address, configuration, files, strict=False, timeout=None):
+    """
+    Send a check request to service at address. Returns the per test results
+    and totals, as returned by CheckService.check().
+    """
+
+    bind = parse_address(address)
+
+    if isinstance(bind, str):
+        conn = UnixHTTPConnection(bind, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(*bind, timeout=timeout)
+
+    # server does not necessarily run in the same directory
+    files = [f if f.startswith("s3://") else os.path.abspath(f) for f in files]
+
+    body = json.dumps({"configuration": configuration, "files": files, "strict": strict})
+
+    try:
+        conn.request("POST", "/check", body, {"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        ret = json.loads(resp.read())
+    except OSError as e:
+        raise CheckRequestError(f"Unable to connect to check service at {address}: {e}")
+    finally:
+        conn.close()
+
+    if resp.status != 200:
+        raise CheckRequestError(f"Check request failed: {ret.get('error')}")
+
+    return ret
@@ -11,3 +11,11 @@ INDEX_KEYS = [
     "endStep",
     "perturbationNumber",
 ]
+
+# packing types where data value bounds and number of missing values can be
+# read from the message header
+HEADER_PACKING_TYPES = ["grid_simple", "grid_ccsds"]
+
+# packing types where single values can be unpacked without decoding the
+# whole message
+SPARSE_PACKING_TYPES = ["grid_simple"]
@@ -0,0 +1,143 @@
+import multiprocessing
+import numpy as np
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from .constants import *
+from .fileutils import (
+    count_data_points,
+    ecc,
+    grid_order,
+    grid_shape,
+    read_head,
+    read_message,
+    read_times,
+)
+
+# shared memory buffers attached in a worker process, by name
+_attached = {}
+
+
+def decode_into(grid, name, size):
+    """
+    Decode a grib message in a worker process, writing the values into the
+    shared memory buffer 'name' if they fit in its size (in bytes). Returns
+    the number of values and other metadata, and the values themselves if
+    they did not fit.
+    """
+
+    gid = ecc.codes_new_from_message(read_message(grid))
+    ecc.codes_set(gid, "missingValue", MISS)
+
+    n = ecc.codes_get_size(gid, "values")
+    ret = {"Size": n, "Shape": grid_shape(gid, n), "Order": grid_order(gid)}
+
+    read_times(gid, ret)
+
+    if n * 8 > size:
+        ret["Values"] = np.array(ecc.codes_get_values(gid))
+    else:
+        shm = _attached.get(name)
+
+        if shm is None:
+            shm = shared_memory.SharedMemory(name=name)
+            # the buffer is owned by the main process, which removes it
+            resource_tracker.unregister(shm._name, "shared_memory")
+            _attached[name] = shm
+
+        np.ndarray((n,), dtype=np.float64, buffer=shm.buf)[:] = ecc.codes_get_values(gid)
+
+    ecc.codes_release(gid)
+
+    return ret
+
+
+class DecodePool:
+    """
+    Worker processes that decode grib messages into shared memory buffers.
+    The main process uses the buffers as numpy arrays without copying, and a
+    buffer is recycled for another message when the last array using it is
+    gone.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = multiprocessing.Pool(workers)
+        self.buffers = []
+        self.free = []
+
+    def acquire(self, size):
+        for i, shm in enumerate(self.free):
+            if shm.size >= size:
+                return self.free.pop(i)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 8))
+        self.buffers.append(shm)
+
+        return shm
+
+    def recycle(self, shm):
+        self.free.append(shm)
+
+    def submit(self, grid):
+        """
+        Start decoding grid, returns a handle for result(). The buffer is
+        sized from the head of the message, which is read here if it has not
+        been read already and passed on so that the worker reads only the
+        rest of the message.
+        """
+
+        if "message" in grid:
+            head = grid["message"]
+        else:
+            if "head" not in grid:
+                # read the message whole if its head cannot be read alone
+                grid = {**grid, "head": read_head(grid) or read_message(grid)}
+            head = grid["head"]
+
+        shm = self.acquire(8 * count_data_points(head))
+        return shm, self.pool.apply_async(decode_into, (grid, shm.name, shm.size))
+
+    def result(self, handle):
+        """Wait for decoding started with submit() to finish"""
+
+        shm, result = handle
+        ret = result.get()
+        size = ret.pop("Size")
+
+        if "Values" in ret:
+            # more values than data points in header, returned as is
+            self.recycle(shm)
+            values = ret.pop("Values")
+        else:
+            values = np.ndarray((size,), dtype=np.float64, buffer=shm.buf)
+            weakref.finalize(values, self.recycle, shm)
+
+        ret["Values"] = np.ma.masked_where(values == MISS, values, copy=False)
+
+        return ret
+
+    def discard(self, handle):
+        """Wait for decoding started with submit() and drop the result"""
+
+        shm, result = handle
+        result.wait()
+        self.recycle(shm)
+
+    def decode(self, grid):
+        return self.result(self.submit(grid))
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+        for shm in self.buffers:
+            try:
+                shm.close()
+            except BufferError:
+                # still in use by an array
+                pass
+            shm.unlink()
+
+        self.buffers = []
+        self.free = []
+
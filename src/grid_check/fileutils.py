@@ -1,80 +1,397 @@
-import eccodes as ecc
-import gribapi
+import importlib
 import numpy as np
 import os
-import fsspec
+import stat
 import logging
+from collections import OrderedDict
 from datetime import datetime,timedelta
 from .constants import *
+from .backends import BACKENDS, LazyValues, detect_backend, index_variables, read_variable
 
 
-def read_grib_message(index, conditions):
-    index_keys = INDEX_KEYS
-    leaf = index
-    for ikey in index_keys:
-        found = False
-        for item in conditions:
-            if item["Key"] == ikey:
-                try:
-                    leaf = leaf[item["Value"]]
-                except KeyError as e:
-                    return None
-                found = True
+class LazyModule:
+    """
+    Module that is imported only when one of its attributes is first used.
+    Keeps startup fast for runs that do not read any data, like validating
+    a configuration or sending a check to a service.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+
+ecc = LazyModule("eccodes")
+gribapi = LazyModule("gribapi")
+
+
+def conditions_to_key(conditions):
+    """
+    Convert list of grib key conditions to a tuple of index key values.
+    """
+    values = {}
+    for item in conditions:
+        values.setdefault(item["Key"], item["Value"])
+
+    return tuple(values.get(k) for k in INDEX_KEYS)
+
+
+def format_key_to_string(key):
+    return "".join("%s=%s " % (k, v) for k, v in zip(INDEX_KEYS, key))
+
+
+def grib_key(gid):
+    """
+    Return the index key values of a grib message as a tuple.
+    """
+    key = []
+    for k in INDEX_KEYS:
+        try:
+            key.append(ecc.codes_get_long(gid, k))
+        except gribapi.errors.KeyValueNotFoundError as e:
+            key.append(None)
+
+    return tuple(key)
+
+
+def message_key(message):
+    gid = ecc.codes_new_from_message(message)
+    key = grib_key(gid)
+    ecc.codes_release(gid)
+
+    return key
+
+
+def is_stream(grib_file):
+    """
+    Check if input is a stream that cannot be indexed: stdin or a named pipe.
+    """
+    if grib_file == "-":
+        return True
+
+    try:
+        return stat.S_ISFIFO(os.stat(grib_file).st_mode)
+    except FileNotFoundError as e:
+        return False
+
+
+def read_grib_stream(fp):
+    """
+    Read grib messages one by one from a binary stream. The stream does not
+    need to be seekable, the length of each message is read from section 0.
+    """
+    while True:
+        head = fp.read(16)
+
+        if len(head) == 0:
+            return
+
+        if len(head) < 16 or head[:4] != b"GRIB":
+            raise ValueError("Invalid grib message in stream")
+
+        edition = head[7]
+
+        if edition == 2:
+            length = int.from_bytes(head[8:16], "big")
+        elif edition == 1:
+            length = int.from_bytes(head[4:7], "big")
+        else:
+            raise ValueError(f"Unsupported grib edition in stream: {edition}")
+
+        body = fp.read(length - 16)
+
+        if len(body) < length - 16:
+            raise ValueError("Truncated grib message in stream")
+
+        yield head + body
+
+
+# names of index keys in key=value fields of wgrib2 style inventories, in
+# addition to the grib key names themselves
+IDX_ALIASES = {
+    "disc": "discipline",
+    "parmcat": "parameterCategory",
+    "parm": "parameterNumber",
+    "number": "perturbationNumber",
+}
+
+# suffixes of index files looked up next to grib files
+INDEX_FILE_SUFFIXES = [".idx", ".gribidx"]
+
+
+def find_index_file(grib_file):
+    """
+    Return an external index file for a grib file, or None. An index file
+    older than the grib file is not used.
+    """
+
+    if grib_file.startswith("s3://"):
+        return None
+
+    for suffix in INDEX_FILE_SUFFIXES:
+        index_file = grib_file + suffix
+
+        if not os.path.exists(index_file):
+            continue
+
+        if os.path.getmtime(index_file) < os.path.getmtime(grib_file):
+            logging.warning(f"Index file {index_file} is older than {grib_file}, not used")
+            continue
+
+        return index_file
+
+    return None
+
+
+def read_wgrib2_inventory(index_file, grib_file):
+    """
+    Read a wgrib2 style inventory: one line per message, with message number,
+    offset and fields separated by colons. Index keys are read from key=value
+    fields (for example 'parmcat=1', or 'var discipline=0 parmcat=1 parm=8'
+    as written by wgrib2 -varX). Every index key must be listed, with value
+    'undef' if the key is missing from the message: keys cannot be read from
+    the descriptive fields of wgrib2, like level and forecast time, so an
+    inventory without them cannot be used. Message length is the distance to
+    the next message.
+    """
+
+    entries = []
+
+    with open(index_file) as fp:
+        for line in fp:
+            fields = line.strip().split(":")
+
+            if len(fields) < 3:
+                continue
+
+            if "." in fields[0]:
+                raise ValueError("submessages are not supported")
+
+            values = {}
+            for field in fields[2:]:
+                for token in field.split():
+                    k, eq, v = token.partition("=")
+                    k = IDX_ALIASES.get(k, k)
+                    if eq and k in INDEX_KEYS:
+                        values[k] = None if v == "undef" else int(v)
+
+            for k in INDEX_KEYS:
+                if k not in values:
+                    raise ValueError(f"{k} not found in inventory line: {line.strip()}")
+
+            entries.append(
+                {
+                    "key": tuple(values.get(k) for k in INDEX_KEYS),
+                    "message_no": int(fields[0]) - 1,
+                    "offset": int(fields[1]),
+                }
+            )
+
+    if len(entries) == 0:
+        raise ValueError("no messages in inventory")
+
+    entries.sort(key=lambda e: e["offset"])
+    ends = [e["offset"] for e in entries[1:]] + [os.path.getsize(grib_file)]
+
+    for e, end in zip(entries, ends):
+        e["length"] = end - e["offset"]
+
+    return entries
+
+
+def read_eccodes_index(index_file, demand=None):
+    """
+    Read the demanded messages through an eccodes index (grib_index_build).
+    The index must be built from the grib file alone, with numeric values of
+    index keys (for example 'grib_index_build -k discipline:l,...') and no
+    other keys than INDEX_KEYS. The index is selected once for each demanded
+    key, so without a demand there is nothing to gain and the index is not
+    used.
+    """
+
+    if demand is None:
+        raise ValueError("eccodes index is used only for demanded messages")
+
+    idx = ecc.codes_index_read(index_file)
+
+    try:
+        choices = []
+
+        for pos, k in enumerate(INDEX_KEYS):
+            try:
+                values = ecc.codes_index_get(idx, k)
+            except gribapi.errors.KeyValueNotFoundError as e:
+                continue
+
+            if not all(v == "undef" or v.lstrip("-").isdigit() for v in values):
+                raise ValueError(f"index key {k} does not have numeric values")
+
+            choices.append((pos, k, set(values)))
+
+        # demanded keys restricted to the keys of the index
+        selections = set(
+            tuple("undef" if key[pos] is None else str(key[pos]) for pos, k, values in choices)
+            for key in demand
+        )
+
+        entries = []
+
+        for selection in sorted(selections):
+            if any(v not in values for (pos, k, values), v in zip(choices, selection)):
+                continue
+
+            for (pos, k, values), v in zip(choices, selection):
+                ecc.codes_index_select(idx, k, v)
+
+            while True:
+                gid = ecc.codes_new_from_index(idx)
+                if gid is None:
+                    break
+
+                entries.append(
+                    {
+                        "key": grib_key(gid),
+                        "message_no": None,
+                        "offset": ecc.codes_get_long(gid, "offset"),
+                        "length": ecc.codes_get_long(gid, "totalLength"),
+                    }
+                )
+                ecc.codes_release(gid)
+    finally:
+        ecc.codes_index_release(idx)
+
+    if len(entries) == 0:
+        raise ValueError("no messages found through index")
+
+    return entries
+
+
+def read_index_file(index_file, grib_file, demand=None, explicit=True):
+    """
+    Read message keys, offsets and lengths of a grib file from an external
+    index file. Returns None if the index cannot be used. That is a warning
+    only if the index file was given explicitly: index files found next to
+    grib files are often plain wgrib2 inventories without index keys.
+    """
+
+    try:
+        with open(index_file, "rb") as fp:
+            head = fp.read(8)
+
+        if b"GRBIDX" in head:
+            entries = read_eccodes_index(index_file, demand)
+        else:
+            entries = read_wgrib2_inventory(index_file, grib_file)
+    except Exception as e:
+        level = logging.WARNING if explicit else logging.DEBUG
+        logging.log(level, f"Unable to use index file {index_file}: {e}")
+        return None
+
+    logging.debug(f"Read {len(entries)} messages from index file {index_file}")
+
+    return entries
+
+
+def scan_grib_file(grib_file, stop):
+    """
+    Read message keys, offsets and lengths by scanning through a grib file.
+    Scanning ends when stop() returns true.
+    """
+
+    wrk_grib_file = grib_file
+
+    if grib_file.startswith("s3://"):
+        wrk_grib_file = read_file_from_s3(grib_file)
+
+    with open(wrk_grib_file) as fp:
+        message_no = 0
+        offset = 0
+        while not stop():
+            gid = ecc.codes_grib_new_from_file(fp)
+            if gid is None:
                 break
-        if not found:
-            logging.debug("Data not found from index")
-            return None
 
-    return leaf
+            key = grib_key(gid)
+            length = ecc.codes_get_long(gid, "totalLength")
+            ecc.codes_release(gid)
+
+            yield {"key": key, "message_no": message_no, "offset": offset, "length": length}
+
+            message_no += 1
+            offset += length
+
+
+def index_grib_files(grib_files, demand=None, index_files=None):
+    """
+    Index grib messages from files. The index is keyed by a tuple of
+    INDEX_KEYS values.
+
+    Message locations are read from external index files when possible:
+    either from the files given in index_files (one for each grib file, or
+    None), or from wgrib2 inventories (.idx) or eccodes indexes (.gribidx)
+    next to the grib files. Files without a usable index are scanned.
 
+    Zarr and NetCDF files are indexed by variable, see
+    backends.index_variables().
 
-def index_grib_files(grib_files):
+    If a demand set of index key tuples is given, only matching messages are
+    indexed, and indexing stops as soon as all demanded messages have been
+    found. Demanded messages that were not found are reported.
+    """
     logging.info("Indexing grib files")
     index = {}
 
-    index_keys = INDEX_KEYS
     cnt = 0
+    found = set()
 
-    for grib_file in grib_files[0]:
-        wrk_grib_file = grib_file
+    def all_found():
+        return demand is not None and len(found) == len(demand)
 
-        if grib_file.startswith("s3://"):
-            wrk_grib_file = read_file_from_s3(grib_file)
+    if index_files is None:
+        index_files = [None] * len(grib_files[0])
 
-        with open(wrk_grib_file) as fp:
-            message_no = 0
-            offset = 0
-            while True:
-                gid = ecc.codes_grib_new_from_file(fp)
-                if gid is None:
-                    break
+    for grib_file, index_file in zip(grib_files[0], index_files):
+        if all_found():
+            logging.info(f"All demanded messages found, skipping file {grib_file}")
+            continue
+
+        backend = detect_backend(grib_file)
+        entries = None
+
+        if backend is not None:
+            entries = index_variables(BACKENDS[backend], grib_file)
+        else:
+            explicit = index_file is not None
+
+            if index_file is None:
+                index_file = find_index_file(grib_file)
 
-                ref = index
-                for k in index_keys:
-                    try:
-                        val = ecc.codes_get_long(gid, k)
-                    except gribapi.errors.KeyValueNotFoundError as e:
-                        val = None
+            if index_file is not None:
+                entries = read_index_file(index_file, grib_file, demand, explicit)
 
-                    if val not in ref:
-                        ref[val] = {}
-                        ref = ref[val]
-                    else:
-                        ref = ref[val]
+            if entries is None:
+                entries = scan_grib_file(grib_file, all_found)
 
-                length = ecc.codes_get_long(gid, "totalLength")
+        for entry in entries:
+            key = entry.pop("key")
 
-                ref["file_name"] = grib_file
-                ref["message_no"] = message_no
-                ref["length"] = length
-                ref["offset"] = offset
+            if demand is None or key in demand:
+                index[key] = {"file_name": grib_file, **entry}
 
-                message_no += 1
-                offset += length
+                found.add(key)
                 cnt += 1
 
     logging.info(f"Indexed {cnt} messages from {len(grib_files[0])} file(s)")
 
+    if demand is not None:
+        for key in demand - found:
+            logging.warning(f"Demanded message not found: {format_key_to_string(key)}")
+
     return index
 
 
@@ -101,6 +418,9 @@ def fsspec_s3():
 
 
 def read_file_from_s3(grib_file):
+    # fsspec (and s3fs through it) is imported only when s3 is actually used
+    import fsspec
+
     uri = "simplecache::{}".format(grib_file)
     s3info = fsspec_s3()
     try:
@@ -114,29 +434,89 @@ def read_file_from_s3(grib_file):
         raise e
 
 
-def read_data(grid):
+def read_message(grid):
     """
-    Read data values from grib file given the offset and length from index.
-    Also provide some additional metadata that is not stored in the index.
+    Read grib message from file given the offset and length from index. If
+    the message was read from a stream, it is given as is in the grid. If
+    the beginning of the message was already read (see read_head()), it is
+    given in key "head" and only the rest is read.
     """
 
-    wrk_grib_file = grid['file_name']
+    if "message" in grid:
+        return grid["message"]
+
+    head = grid.get("head", b"")
+
+    if len(head) == grid["length"]:
+        return head
+
+    wrk_grib_file = grid["file_name"]
+
+    if wrk_grib_file.startswith("s3://"):
+        wrk_grib_file = read_file_from_s3(wrk_grib_file)
+
+    with open(wrk_grib_file, "rb") as fp:
+        fp.seek(grid["offset"] + len(head), 0)
+        return head + fp.read(grid["length"] - len(head))
+
+
+def read_head(grid):
+    """
+    Read the sections of a grib 2 message before its bitmap and data
+    sections, which is all that read_header() needs. Grib 1 messages and
+    messages read from a stream are given whole. Returns None if the message
+    ends before its data section, so that it is read whole instead.
+    """
+
+    if "message" in grid:
+        return grid["message"]
+
+    wrk_grib_file = grid["file_name"]
 
     if wrk_grib_file.startswith("s3://"):
         wrk_grib_file = read_file_from_s3(wrk_grib_file)
 
     with open(wrk_grib_file, "rb") as fp:
         fp.seek(grid["offset"], 0)
-        buff = fp.read(grid["length"])
-        fp.close()
+        head = fp.read(16)
 
-    gid = ecc.codes_new_from_message(buff)
-    ecc.codes_set(gid, "missingValue", MISS)
+        if len(head) < 16:
+            return None
 
-    ret = {}
-    values = np.array(ecc.codes_get_values(gid))
-    ret["Values"] = np.ma.masked_where(values == MISS, values)
+        if head[7] != 2:
+            return head + fp.read(grid["length"] - 16)
+
+        while True:
+            section = fp.read(5)
+
+            if len(section) < 5:
+                return None
+
+            if section[:4] == b"7777" or section[4] in (6, 7):
+                return head
+
+            head += section + fp.read(int.from_bytes(section[:4], "big") - 5)
 
+
+def header_message(head):
+    """
+    Complete the head of a grib 2 message with an empty bitmap and data
+    section, so that its header can be parsed without the data.
+    """
+
+    if head[7] != 2 or int.from_bytes(head[8:16], "big") == len(head):
+        return head
+
+    message = bytearray(head)
+    message += (6).to_bytes(4, "big") + bytes([6, 255])
+    message += (5).to_bytes(4, "big") + bytes([7])
+    message += b"7777"
+    message[8:16] = len(message).to_bytes(8, "big")
+
+    return bytes(message)
+
+
+def read_times(gid, ret):
     dd = ecc.codes_get_long(gid, "dataDate")
     dt = ecc.codes_get_long(gid, "dataTime")
     es = ecc.codes_get_long(gid, "endStep")
@@ -144,36 +524,464 @@ def read_data(grid):
     ret["AnalysisTime"] = datetime.strptime(f"{dd}{dt:04d}", "%Y%m%d%H%M")
     ret["ForecastTime"] = ret["AnalysisTime"] + timedelta(hours=es)
 
+
+def grid_shape(gid, size):
+    """
+    Return the 2-D shape of the values of a grib message as (Nj, Ni), rows
+    along j and columns along i, or None for grids without regular rows and
+    columns, like reduced grids. See grid_order() for the order of values.
+    """
+
+    try:
+        ni = ecc.codes_get_long(gid, "Ni")
+        nj = ecc.codes_get_long(gid, "Nj")
+    except gribapi.errors.GribInternalError as e:
+        return None
+
+    if ni <= 0 or nj <= 0 or ni * nj != size:
+        return None
+
+    return (nj, ni)
+
+
+def grid_order(gid):
+    """
+    Return the order of the values of a grib message in a field of
+    grid_shape(), as numpy order: "F" if j points are consecutive, "C" if
+    i points are.
+    """
+
+    try:
+        consecutive = ecc.codes_get_long(gid, "jPointsAreConsecutive")
+    except gribapi.errors.GribInternalError as e:
+        return "C"
+
+    return "F" if consecutive == 1 else "C"
+
+
+# number of set bits in each byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1, dtype=np.int64)
+
+
+class PackedValues(LazyValues):
+    """
+    Values of a grib 2 message with simple packing, decoded only when
+    needed. take() unpacks only the requested points from the data section,
+    locating them through the bitmap if there is one. read() decodes the
+    whole message with eccodes.
+    """
+
+    def __init__(self, message, gid):
+        self.message = message
+        self.size = ecc.codes_get_long(gid, "numberOfDataPoints")
+        self.shape = (self.size,)
+        self.valid_size = ecc.codes_get_long(gid, "numberOfValues")
+        self.chunks_read = 0
+        self.values = None
+
+        self.ref = ecc.codes_get_double(gid, "referenceValue")
+        self.bits = ecc.codes_get_long(gid, "bitsPerValue")
+        self.bscale = 2.0 ** ecc.codes_get_long(gid, "binaryScaleFactor")
+        # like eccodes does, to get the same values
+        self.dscale = 1.0 / 10.0 ** ecc.codes_get_long(gid, "decimalScaleFactor")
+
+        # padded so that 8 bytes can be read from the start of any value
+        self.data = np.frombuffer(
+            message + bytes(8),
+            dtype=np.uint8,
+            offset=ecc.codes_get_long(gid, "offsetSection7") + 5,
+        )
+        self.bitmap = None
+        self.ranks = None
+
+        if ecc.codes_get_long(gid, "bitMapIndicator") == 0:
+            offset = ecc.codes_get_long(gid, "offsetSection6") + 6
+            self.bitmap = np.frombuffer(message, dtype=np.uint8, count=-(-self.size // 8), offset=offset)
+
+    def read(self):
+        """Decode all values as a flat masked array"""
+
+        if self.values is None:
+            gid = ecc.codes_new_from_message(self.message)
+            ecc.codes_set(gid, "missingValue", MISS)
+            values = np.array(ecc.codes_get_values(gid))
+            ecc.codes_release(gid)
+
+            self.values = np.ma.masked_where(values == MISS, values)
+            self.chunks_read += 1
+
+        return self.values
+
+    def take(self, indices):
+        """Unpack values at flat indices as a masked array"""
+
+        if self.values is not None:
+            return self.values[indices]
+
+        indices = np.asarray(indices, dtype=np.int64)
+        positions = indices
+        missing = np.zeros(indices.size, dtype=bool)
+
+        if self.bitmap is not None:
+            if self.ranks is None:
+                # number of values before each byte of the bitmap
+                self.ranks = np.concatenate([[0], np.cumsum(POPCOUNT[self.bitmap])]).astype(np.int64)
+
+            byte = self.bitmap[indices >> 3]
+            shift = 8 - (indices & 7)
+            missing = (byte >> (shift - 1)) & 1 == 0
+            positions = self.ranks[indices >> 3] + POPCOUNT[byte >> shift]
+
+        # each value is read from the 8 bytes starting at its first byte
+        start = positions * self.bits
+        words = self.data[(start >> 3)[:, None] + np.arange(8)].view(">u8").ravel()
+        x = (words >> (64 - self.bits - (start & 7)).astype(np.uint64)) & np.uint64(
+            (1 << self.bits) - 1
+        )
+        values = (x * self.bscale + self.ref) * self.dscale
+
+        self.chunks_read += 1
+
+        return np.ma.masked_array(np.where(missing, MISS, values), mask=missing)
+
+
+def sparse_packing(gid):
+    """
+    Return true if single values of a message can be unpacked without
+    decoding the whole message.
+    """
+
+    return (
+        ecc.codes_get_long(gid, "editionNumber") == 2
+        and ecc.codes_get_string(gid, "packingType") in SPARSE_PACKING_TYPES
+        and ecc.codes_get_long(gid, "bitMapIndicator") in (0, 255)
+        and ecc.codes_get_long(gid, "bitsPerValue") <= 56
+    )
+
+
+def read_data(grid):
+    """
+    Read data values from grib file given the offset and length from index.
+    Also provide some additional metadata that is not stored in the index.
+    Values of other formats are read lazily by their backend, and values of
+    messages with simple packing are unpacked lazily, see PackedValues.
+    """
+
+    if "backend" in grid:
+        return read_variable(BACKENDS[grid["backend"]], grid)
+
+    message = read_message(grid)
+    gid = ecc.codes_new_from_message(message)
+
+    ret = {}
+
+    if sparse_packing(gid):
+        ret["Values"] = PackedValues(message, gid)
+        ret["Shape"] = grid_shape(gid, ret["Values"].size)
+        ret["Order"] = grid_order(gid)
+    else:
+        ecc.codes_set(gid, "missingValue", MISS)
+        values = np.array(ecc.codes_get_values(gid))
+        ret["Values"] = np.ma.masked_where(values == MISS, values)
+        ret["Shape"] = grid_shape(gid, values.size)
+        ret["Order"] = grid_order(gid)
+
+    read_times(gid, ret)
+
     ecc.codes_release(gid)
 
     return ret
 
 
-def read_grids(index, parameters):
-    def format_metadata_to_string(metadata):
-        string = ""
-        for m in metadata:
-            string += "%s=%s " % (m["Key"], m["Value"])
+def count_data_points(head):
+    """
+    Return the number of data points of a grib message from its head, see
+    read_head().
+    """
+
+    gid = ecc.codes_new_from_message(header_message(head))
+    count = ecc.codes_get_long(gid, "numberOfDataPoints")
+    ecc.codes_release(gid)
 
-        return string
+    return count
 
-    grids = {}
-    for param in parameters:
-        grid = read_grib_message(index, parameters[param]["Grib2MetaData"])
 
-        if grid is not None:
-            logging.debug(
-                f"Read {format_metadata_to_string(parameters[param]['Grib2MetaData'])}"
-            )
-            grids[param] = read_data(grid)
+def read_header(grid, head=None):
+    """
+    Read metadata of a grib message without decoding the data values. Only
+    the head of the message is read, if it is not given, see read_head().
+
+    For packing types where values are stored as Y = (R + X * 2^E) / 10^D
+    with X in [0, 2^bitsPerValue - 1], and missing values only in bitmap,
+    the header gives bounds for the values and the exact number of missing
+    values. For other packing types and formats only the times are given.
+    """
+
+    if "backend" in grid:
+        return {"PackingType": None, **read_variable(BACKENDS[grid["backend"]], grid, True)}
+
+    if head is None:
+        head = read_head(grid)
+
+    if head is None:
+        head = read_message(grid)
+
+    gid = ecc.codes_new_from_message(header_message(head))
+
+    ret = {"PackingType": ecc.codes_get_string(gid, "packingType")}
+
+    read_times(gid, ret)
+
+    if ret["PackingType"] in HEADER_PACKING_TYPES:
+        ref = ecc.codes_get_double(gid, "referenceValue")
+        bits = ecc.codes_get_long(gid, "bitsPerValue")
+        e = ecc.codes_get_long(gid, "binaryScaleFactor")
+        d = ecc.codes_get_long(gid, "decimalScaleFactor")
+
+        ret["Min"] = ref / 10.0**d
+        ret["Max"] = (ref + (2**bits - 1) * 2.0**e) / 10.0**d
+        ret["NumberOfValues"] = ecc.codes_get_long(gid, "numberOfValues")
+        ret["NumberOfDataPoints"] = ecc.codes_get_long(gid, "numberOfDataPoints")
+        ret["NumberOfMissing"] = ret["NumberOfDataPoints"] - ret["NumberOfValues"]
 
-    diff = list(set(parameters) - set(grids.keys()))
+    ecc.codes_release(gid)
+
+    return ret
+
+
+class RetainedGrids:
+    """
+    Grids retained by grid caches after their last expected read, at most
+    max_size of them, least recently used first out. Grids are kept apart
+    by the cache (scope) that retained them.
+    """
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self.grids = OrderedDict()
+
+    def __len__(self):
+        return len(self.grids)
+
+    def contains(self, scope, key):
+        return (scope, key) in self.grids
+
+    def get(self, scope, key):
+        data = self.grids.get((scope, key))
+
+        if data is not None:
+            self.grids.move_to_end((scope, key))
+
+        return data
+
+    def pop(self, scope, key):
+        return self.grids.pop((scope, key), None)
+
+    def put(self, scope, key, data):
+        if self.max_size == 0:
+            return
+
+        self.grids[(scope, key)] = data
+        self.grids.move_to_end((scope, key))
 
-    if len(diff) > 0:
-        for param in diff:
+        while len(self.grids) > self.max_size:
+            self.grids.popitem(last=False)
+
+    def drop(self, scope):
+        """Forget all grids retained by scope"""
+
+        for k in [k for k in self.grids if k[0] is scope]:
+            del self.grids[k]
+
+
+class GridCache:
+    """
+    Decoded grids shared between test units, keyed by index key. Readers
+    announce the grids they are going to read with expect(), and a grid is
+    decoded only once and kept in memory until its last expected read.
+
+    If max_size is given, up to that many grids that are not expected anymore
+    are retained, least recently used first out, so that they can be reused
+    by later checks of the same files. Caches can share one RetainedGrids,
+    and then max_size of that applies to all of them together.
+
+    Readers that can do with metadata only use read_header(). Only the head
+    of a message is read for its header, and it is kept so that the message
+    is not read again from its beginning if it is decoded after all. Grids
+    whose headers were read but that were never decoded are counted in
+    avoided.
+
+    If a decode pool (decode.DecodePool) is given, grib messages are decoded
+    in worker processes, and grids can be prefetched: decoded ahead of their
+    first read.
+    """
+
+    def __init__(self, max_size=0, pool=None, retained=None):
+        self.pool = pool
+        self.pending = {}
+        self.grids = {}
+        self.refs = {}
+        self.headers = {}
+        self.heads = {}
+        self.retained = RetainedGrids(max_size) if retained is None else retained
+        self.decoded = 0
+        self.reused = 0
+        self.avoided = 0
+        self.peak = 0
+        self.undecoded = set()
+
+    def expect(self, keys):
+        for key in keys:
+            self.refs[key] = self.refs.get(key, 0) + 1
+
+            if self.retained.contains(self, key):
+                self.grids[key] = self.retained.pop(self, key)
+
+    def release(self, key):
+        if key not in self.refs:
+            return
+
+        self.refs[key] -= 1
+
+        if self.refs[key] == 0:
+            self.refs.pop(key)
+            self.headers.pop(key, None)
+            self.heads.pop(key, None)
+
+            if key in self.pending:
+                # prefetched but never read
+                self.pool.discard(self.pending.pop(key))
+            self.retain(key, self.grids.pop(key, None))
+
+            if key in self.undecoded:
+                self.undecoded.discard(key)
+                self.avoided += 1
+
+    def retain(self, key, data):
+        if data is not None:
+            self.retained.put(self, key, data)
+
+    def with_head(self, key, grid):
+        if key not in self.heads:
+            return grid
+
+        return {**grid, "head": self.heads[key]}
+
+    def read(self, key, grid, expected=True):
+        """
+        Read a grid. If the read was announced with expect(), the grid is
+        released after it. Otherwise a grid that is decoded or retained
+        already is used, but a newly decoded grid is not kept for other
+        readers.
+        """
+
+        data = self.grids.get(key)
+
+        if data is None:
+            data = self.retained.get(self, key)
+
+        if data is None:
+            grid = self.with_head(key, grid)
+
+            if key in self.pending:
+                data = self.pool.result(self.pending.pop(key))
+            elif self.pool is not None and "backend" not in grid:
+                data = self.pool.decode(grid)
+            else:
+                data = read_data(grid)
+            self.decoded += 1
+            self.heads.pop(key, None)
+            self.undecoded.discard(key)
+
+            if key in self.refs and expected:
+                self.grids[key] = data
+                self.peak = max(self.peak, len(self.grids))
+            else:
+                self.retain(key, data)
+        else:
+            self.reused += 1
+
+        if expected:
+            self.release(key)
+
+        return data
+
+    def prefetch(self, key, grid):
+        """
+        Start decoding a grid that is going to be read, if there is a decode
+        pool and the grid is not decoded or being decoded already.
+        """
+
+        if (
+            self.pool is None
+            or key in self.grids
+            or self.retained.contains(self, key)
+            or key in self.pending
+            or key not in self.refs
+            or "backend" in grid
+        ):
+            return
+
+        self.pending[key] = self.pool.submit(self.with_head(key, grid))
+
+    def read_header(self, key, grid):
+        """
+        Read header of a grid. The grid is not released, as it is decoded
+        anyway if the header is not enough: call release() when it is.
+        """
+
+        header = self.headers.get(key)
+
+        if header is None:
+            if "backend" in grid:
+                header = read_header(grid)
+            else:
+                head = read_head(grid)
+                header = read_header(grid, head)
+
+                if key in self.refs and head is not None:
+                    self.heads[key] = head
+
+            if key in self.refs:
+                self.headers[key] = header
+
+            if key not in self.grids and not self.retained.contains(self, key):
+                self.undecoded.add(key)
+
+        return header
+
+
+def read_grids(index, keys, cache=None, expected=True):
+    """
+    Read grids for all (parameter, index key) pairs in keys. If any of them is
+    not found from index, nothing is read. If cache is given, grids are read
+    through it, and expected tells if the reads were announced with
+    GridCache.expect().
+    """
+
+    grids = {}
+    for param, key in keys:
+        grid = index.get(key)
+
+        if grid is None:
             logging.warning(
-                f"Unable to find data for '{param}': {format_metadata_to_string(parameters[param]['Grib2MetaData'])}"
+                f"Unable to find data for '{param}': {format_key_to_string(key)}"
             )
+            continue
+
+        grids[param] = grid
+
+    if len(grids) < len(keys):
+        if cache is not None and expected:
+            for param, key in keys:
+                cache.release(key)
         return {}
 
+    for param, key in keys:
+        logging.debug(f"Read {format_key_to_string(key)}")
+        if cache is None:
+            grids[param] = read_data(grids[param])
+        else:
+            grids[param] = cache.read(key, grids[param], expected)
+
     return grids
@@ -0,0 +1,211 @@
+import logging
+
+
+class Message:
+    """
+    Message of a test outcome that is formatted only when it is used. Holds
+    a str.format() template and the raw values to format it with.
+    """
+
+    __slots__ = ("template", "values")
+
+    def __init__(self, template, *values):
+        self.template = template
+        self.values = values
+
+    def __str__(self):
+        return self.template.format(*self.values)
+
+    def __repr__(self):
+        return repr(str(self))
+
+
+def format_metadata_to_string(metadata):
+    string = ""
+    for m in metadata:
+        string += "%s=%s " % (m["Key"], m["Value"])
+
+    return string
+
+
+class Summary:
+    """
+    Outcome of a test for one sample: the status of the test and the
+    identifiers of the sample. The message is formatted only when it is
+    used. Items are read like from the dicts that results are serialized to,
+    see as_dict().
+    """
+
+    __slots__ = (
+        "name",
+        "return_value",
+        "status_message",
+        "parameter",
+        "analysis_time",
+        "forecast_time",
+        "leadtime",
+        "forecast_type",
+    )
+
+    def __init__(
+        self,
+        name,
+        return_value,
+        status_message,
+        parameter,
+        analysis_time,
+        forecast_time,
+        leadtime,
+        forecast_type=None,
+    ):
+        self.name = name
+        self.return_value = return_value
+        self.status_message = status_message
+        self.parameter = parameter
+        self.analysis_time = analysis_time
+        self.forecast_time = forecast_time
+        self.leadtime = leadtime
+        # metadata of the forecast type, if it is shown in message
+        self.forecast_type = forecast_type
+
+    @property
+    def message(self):
+        message = ""
+
+        if self.forecast_type is not None:
+            message = f"Forecast type: {format_metadata_to_string(self.forecast_type)}"
+
+        return message + "{} for {} +{:.0f}h ({}): {}".format(
+            self.parameter,
+            self.analysis_time,
+            self.leadtime.total_seconds() / 3600,
+            self.forecast_time,
+            self.status_message,
+        )
+
+    def __getitem__(self, key):
+        if key not in ("name", "return_value", "message"):
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if isinstance(other, Summary):
+            other = other.as_dict()
+
+        return self.as_dict() == other
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "return_value": self.return_value,
+            "message": self.message,
+        }
+
+
+def to_json(obj):
+    """
+    Serialize result records for json.dump(), use as its default argument.
+    """
+
+    if isinstance(obj, Summary):
+        return obj.as_dict()
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def report(all_summaries, strict=False):
+    """
+    Log the results of single tests. Returns the totals, the failed tests and
+    the exit code for the whole check.
+    """
+
+    all_success = 0
+    all_fail = 0
+    all_skip = 0
+
+    return_code = 0
+    combined_errors = []
+
+    def log(level, summary):
+        # messages are formatted only if they are logged
+        if logging.getLogger().isEnabledFor(level):
+            logging.log(level, summary["message"])
+
+    def handle_result(summaries):
+        success = summaries["success"]
+        fail = summaries["fail"]
+        skip = summaries["skip"]
+
+        if len(summaries["summary"]) == 0:
+            logging.info("No grids checked")
+            retval = 1
+
+        for summary in summaries["summary"]:
+            retval = summary["return_value"]
+            if retval == 0:
+                # test was successful
+                log(logging.INFO, summary)
+            elif retval == -1:
+                # test was skipped with ok status, for example month didn't match
+                # log with debug level as it was not a failure and produces a lot of output
+                log(logging.DEBUG, summary)
+            elif retval == 1:
+                # test failed
+                logging.error(summary["message"])
+                combined_errors.append(
+                    {"name": summary["name"], "message": summary["message"]}
+                )
+
+        return success, fail, skip, retval
+
+    for summaries in all_summaries:
+        success, fail, skip, retval = handle_result(summaries)
+        all_success += success
+        all_fail += fail
+        all_skip += skip
+
+        if retval > return_code:
+            return_code = retval
+
+    logging.info(
+        f"Total Summary: successful tests: {all_success}, failed: {all_fail}, skipped: {all_skip}"
+    )
+
+    if len(combined_errors) > 0:
+        logging.error("Summary of errors:")
+        for err in combined_errors:
+            logging.error("'{}': {}".format(err["name"], err["message"]))
+
+    if strict and (all_fail > 0 or all_skip > 0):
+        return_code = 1
+
+    return {
+        "success": all_success,
+        "fail": all_fail,
+        "skip": all_skip,
+        "errors": combined_errors,
+        "return_code": return_code,
+    }
+
+
+def report_batch(all_results, strict=False):
+    """
+    Report the results of several configurations, given as a list of
+    (name, results) tuples. Returns a dict of exit codes by configuration
+    name.
+    """
+
+    return_codes = {}
+
+    for name, results in all_results:
+        logging.info(f"Results for configuration {name}")
+        return_codes[name] = report(results, strict)["return_code"]
+
+    for name, return_code in return_codes.items():
+        logging.info(f"Configuration {name}: exit code {return_code}")
+
+    return return_codes
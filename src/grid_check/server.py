@@ -0,0 +1,210 @@
+import http.server
+import json
+import logging
+import os
+import socketserver
+from collections import OrderedDict
+from .check import SampleOrders, compile_demand, compile_plans, execute_plans
+from .client import CheckRequestError, is_loopback, parse_address, request_check
+from .fileutils import GridCache, RetainedGrids, index_grib_files
+from .results import report, to_json
+
+# how many different sets of input files are kept indexed
+MAX_INPUTS = 8
+
+# fields that a check request must have
+REQUEST_FIELDS = ["configuration", "files"]
+
+
+class UnknownConfigurationError(KeyError):
+    pass
+
+
+class CheckService:
+    """
+    Configurations loaded once, and indexes and decoded grids of recently
+    checked files kept in memory between check requests. At most max_grids
+    decoded grids are kept in total, over all sets of files. Samples are drawn
+    from random orders of grid points that are also kept between requests.
+    If a decode pool is given, grids are decoded in its worker processes.
+    """
+
+    def __init__(self, configurations, max_grids=64, pool=None):
+        self.configurations = {}
+        self.inputs = OrderedDict()
+        self.retained = RetainedGrids(max_grids)
+        self.pool = pool
+        self.demand = set()
+        self.orders = SampleOrders()
+
+        for name, config, dims in configurations:
+            plans = compile_plans(config, dims)
+            self.configurations[name] = plans
+            self.demand.update(compile_demand(config, dims, plans))
+
+    def find_configuration(self, name):
+        if name in self.configurations:
+            return self.configurations[name]
+
+        # allow using the file name only
+        matches = [
+            c for c in self.configurations if os.path.basename(c) == os.path.basename(name)
+        ]
+
+        if len(matches) == 1:
+            return self.configurations[matches[0]]
+
+        raise UnknownConfigurationError(f"Unknown configuration: {name}")
+
+    def open_input(self, files):
+        """
+        Return index and grid cache for files. Files are indexed again if any
+        of them has changed since the last check.
+        """
+
+        key = tuple(files)
+        stamp = []
+
+        for f in files:
+            if f.startswith("s3://"):
+                stamp.append(None)
+            else:
+                st = os.stat(f)
+                stamp.append((st.st_mtime_ns, st.st_size))
+
+        state = self.inputs.get(key)
+
+        if state is None or state["stamp"] != stamp:
+            if state is not None:
+                self.retained.drop(state["cache"])
+
+            state = {
+                "stamp": stamp,
+                "index": index_grib_files([list(files)], self.demand),
+                "cache": GridCache(pool=self.pool, retained=self.retained),
+            }
+            self.inputs[key] = state
+
+        self.inputs.move_to_end(key)
+
+        while len(self.inputs) > MAX_INPUTS:
+            self.retained.drop(self.inputs.popitem(last=False)[1]["cache"])
+
+        return state["index"], state["cache"]
+
+    def check(self, name, files, strict=False):
+        plans = self.find_configuration(name)
+        index, cache = self.open_input(files)
+
+        results = execute_plans([plans], index, cache, self.orders)[0]
+
+        return {"configuration": name, "results": results, **report(results, strict)}
+
+
+class CheckRequestHandler(http.server.BaseHTTPRequestHandler):
+    def address_string(self):
+        # unix socket clients do not have an address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=to_json).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/configurations":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+
+        self.send_json(200, {"configurations": list(self.server.service.configurations)})
+
+    def do_POST(self):
+        if self.path != "/check":
+            self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid request: {e}"})
+            return
+
+        missing = [f for f in REQUEST_FIELDS if not isinstance(req, dict) or f not in req]
+
+        if len(missing) > 0:
+            self.send_json(400, {"error": f"Missing fields in request: {', '.join(missing)}"})
+            return
+
+        try:
+            ret = self.server.service.check(
+                req["configuration"], req["files"], req.get("strict", False)
+            )
+        except UnknownConfigurationError as e:
+            self.send_json(400, {"error": e.args[0]})
+            return
+        except OSError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        except Exception as e:
+            logging.exception("Check request failed")
+            self.send_json(500, {"error": str(e)})
+            return
+
+        self.send_json(200, ret)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class TCPCheckServer(http.server.HTTPServer):
+    pass
+
+
+class UnixCheckServer(socketserver.UnixStreamServer):
+    pass
+
+
+def serve(address, configurations, max_grids=64, allow_remote=False, pool=None):
+    """
+    Run check service at address until interrupted. Requests are handled one
+    at a time.
+
+    The service reads any file a client asks for and has no authentication,
+    so tcp sockets are bound only to loopback addresses unless allow_remote
+    is set.
+    """
+
+    bind = parse_address(address)
+
+    if not isinstance(bind, str) and not allow_remote and not is_loopback(bind[0]):
+        raise ValueError(
+            f"Refusing to serve checks at non-loopback address {address}, see --allow-remote"
+        )
+
+    service = CheckService(configurations, max_grids, pool)
+
+    if isinstance(bind, str):
+        if os.path.exists(bind):
+            os.unlink(bind)
+        server = UnixCheckServer(bind, CheckRequestHandler)
+    else:
+        server = TCPCheckServer(bind, CheckRequestHandler)
+
+    server.service = service
+
+    logging.info(f"Serving checks at {address}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(bind, str) and os.path.exists(bind):
+            os.unlink(bind)
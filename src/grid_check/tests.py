@@ -1,5 +1,17 @@
+import functools
 import logging
+import os
 import numpy as np
+from .results import Message
+
+# Samples are evaluated in chunks of this size, so that temporary arrays
+# stay small and memory use does not depend on grid size. Can be changed
+# per test with ChunkSize.
+CHUNK_SIZE = 1 << 20
+
+# Percentiles of samples larger than this are approximated with a fixed-bin
+# histogram instead of an exact (copying) selection
+EXACT_LIMIT = 1 << 20
 
 # format string so that None is printed as "None" and other values
 # are printed as requested
@@ -11,30 +23,223 @@ def f(val, str=None):
     return f"{val:{str}}" if str is not None else f"{val}"
 
 
+def blocks(arr, size=None):
+    """Split array into consecutive blocks"""
+    size = CHUNK_SIZE if size is None else size
+    for i in range(0, arr.size, size):
+        yield arr[i : i + size]
+
+
+def chunks(values, size=None):
+    """Split values into chunks, with missing values removed"""
+    for block in blocks(values, size):
+        if np.ma.isMaskedArray(block):
+            block = block.compressed()
+        yield block
+
+
+def paired_chunks(arrays, size=None):
+    """
+    Split arrays of the same size into chunks at the same positions, with
+    points where any of the arrays has a missing value removed
+    """
+    size = CHUNK_SIZE if size is None else size
+    for start in range(0, arrays[0].size, size):
+        block = [a[start : start + size] for a in arrays]
+        valid = ~np.logical_or.reduce([np.ma.getmaskarray(b) for b in block])
+        yield [np.ma.getdata(b)[valid] for b in block]
+
+
+def sample_count(sample_size, size):
+    """Number of values in a sample of given size (count or percentage)"""
+
+    if "%" in str(sample_size):
+        return int(float(sample_size[:-1]) * 0.01 * size)
+
+    return sample_size
+
+
+def sample_fits(sample_size, size, whole=False):
+    """
+    Check if a sample of given size (count or percentage) can be taken from
+    size values. If whole is set, the sample must also cover all of them.
+    """
+
+    sample_size = sample_count(sample_size, size)
+
+    if sample_size is None or size == 0 or sample_size > size:
+        return False
+
+    return sample_size == size or not whole
+
+
+def count_valid(values):
+    return values.size - np.ma.count_masked(values)
+
+
+def chunked_moments(values, size=None):
+    """
+    Count, mean and sum of squared differences from mean of values,
+    accumulated chunk by chunk.
+    """
+
+    n = 0
+    mean = 0.0
+    m2 = 0.0
+
+    for chunk in chunks(values, size):
+        if chunk.size == 0:
+            continue
+
+        chunk_mean = np.mean(chunk)
+        chunk_m2 = np.sum(np.square(chunk - chunk_mean))
+
+        total = n + chunk.size
+        delta = chunk_mean - mean
+        mean += delta * chunk.size / total
+        m2 += chunk_m2 + delta * delta * n * chunk.size / total
+        n = total
+
+    return n, mean, m2
+
+
+def member_moments(state, values):
+    """
+    Add values of one ensemble member to count, mean and sum of squared
+    differences from mean of each point (Welford's algorithm). Missing
+    values are not counted. Give None as state for the first member.
+    """
+
+    valid = ~np.ma.getmaskarray(values)
+    x = np.ma.getdata(values)
+
+    if state is None:
+        return valid.astype(np.int64), np.where(valid, x, 0.0), np.zeros(x.size)
+
+    n, mean, m2 = state
+
+    n += valid
+    delta = np.where(valid, x - mean, 0.0)
+    mean += delta / np.maximum(n, 1)
+    m2 += delta * np.where(valid, x - mean, 0.0)
+
+    return n, mean, m2
+
+
+def histogram_percentile(values, q, bins, size=None):
+    """
+    Approximate q'th percentile of values from a histogram of fixed size.
+    Memory use is bounded by the number of bins and chunk size, and the
+    error is at most the width of one bin.
+    """
+
+    lo = min(np.amin(c) for c in chunks(values, size) if c.size > 0)
+    hi = max(np.amax(c) for c in chunks(values, size) if c.size > 0)
+
+    if lo == hi:
+        return lo
+
+    scale = bins / (hi - lo)
+    counts = np.zeros(bins, dtype=np.int64)
+
+    for chunk in chunks(values, size):
+        idx = ((chunk - lo) * scale).astype(np.int64)
+        np.minimum(idx, bins - 1, out=idx)
+        counts += np.bincount(idx, minlength=bins)
+
+    # rank of the percentile, like np.percentile with linear interpolation
+    rank = q * 0.01 * (counts.sum() - 1)
+    cumulative = np.cumsum(counts)
+    b = min(int(np.searchsorted(cumulative, rank, side="right")), bins - 1)
+    before = cumulative[b] - counts[b]
+    within = (rank - before) / counts[b] if counts[b] > 0 else 0
+
+    return lo + (b + within) / scale
+
+
 class EnvelopeTest:
     def __init__(self, config):
         self.min = config["Test"].get("MinAllowed", None)
         self.max = config["Test"].get("MaxAllowed", None)
         self.name = config.get("Name", "EnvelopeTest")
         self.month = config["Test"].get("Month", None)
+        self.chunk_size = config.get("ChunkSize", None)
+        self.sample_size = config.get("Sample")
         if self.min is None and self.max is None:
             raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
 
-    def __call__(self, sample):
-        sample_min = np.amin(sample["Values"])
-        sample_max = np.amax(sample["Values"])
+    def month_mismatch(self, sample):
+        if self.month is not None and sample["ForecastTime"].month != self.month:
+            retval = -1  # DISABLED
+            message = Message(
+                "Test skipped due to month mismatch (expected: {}, got: {})",
+                self.month, sample["ForecastTime"].month,
+            )
+            return {"name": self.name, "return_code": retval, "message": message}
+
+        return None
+
+    def from_header(self, header):
+        """
+        Pass the test without decoding if the value bounds in grib header are
+        within limits. Returns None if the header is not conclusive.
+        """
+
+        status = self.month_mismatch(header)
 
+        if status is not None:
+            return status
+
+        if "Min" not in header or not sample_fits(self.sample_size, header["NumberOfValues"]):
+            return None
+
+        if (self.min is not None and header["Min"] < self.min) or (
+            self.max is not None and header["Max"] > self.max
+        ):
+            return None
+
+        logging.debug(
+            "Executing ENVELOPE test '%s' from grib header, allowed range: [%s %s]",
+            self.name, self.min, self.max,
+        )
+
+        return {
+            "name": self.name,
+            "return_code": 0,
+            "message": Message(
+                "Min and max within [{:.2f} {:.2f}] (grib header), limits [{} {}], sample={}",
+                header["Min"], header["Max"], self.min, self.max,
+                sample_count(self.sample_size, header["NumberOfValues"]),
+            ),
+        }
+
+    def __call__(self, sample):
         retval = 0  # OK
 
-        message = f"Min and max [{sample_min:.2f} {sample_max:.2f}], limits [{self.min} {self.max}], sample={sample['Values'].size}"
+        status = self.month_mismatch(sample)
 
-        if self.month is not None and sample["ForecastTime"].month != self.month:
-            retval = -1  # DISABLED
-            message = f"Test skipped due to month mismatch (expected: {self.month}, got: {sample['ForecastTime'].month})"
-            return {"name": self.name, "return_code": retval, "message": message}
+        if status is not None:
+            return status
+
+        size = 0
+        sample_min = np.inf
+        sample_max = -np.inf
+
+        for chunk in chunks(sample["Values"], self.chunk_size):
+            if chunk.size == 0:
+                continue
+            size += chunk.size
+            sample_min = min(sample_min, np.amin(chunk))
+            sample_max = max(sample_max, np.amax(chunk))
+
+        message = Message(
+            "Min and max [{:.2f} {:.2f}], limits [{} {}], sample={}",
+            sample_min, sample_max, self.min, self.max, size,
+        )
 
         logging.debug(
-            f"Executing ENVELOPE test '{self.name}', allowed range: [{self.min} {self.max}]"
+            "Executing ENVELOPE test '%s', allowed range: [%s %s]",
+            self.name, self.min, self.max,
         )
 
         if (self.min is not None and sample_min < self.min) or (
@@ -57,15 +262,18 @@ class VarianceTest:
             self.max = config["Test"].get("MaxVariance", None)
 
         self.name = config.get("Name", "EnvelopeTest")
+        self.chunk_size = config.get("ChunkSize", None)
 
         if self.min is None and self.max is None:
             raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
 
     def __call__(self, sample):
-        sample_var = np.var(sample["Values"])
+        size, mean, m2 = chunked_moments(sample["Values"], self.chunk_size)
+        sample_var = m2 / size if size > 0 else np.nan
 
         logging.debug(
-            f"Executing VARIANCE test '{self.name}', allowed range: [{self.min} {self.max}]"
+            "Executing VARIANCE test '%s', allowed range: [%s %s]",
+            self.name, self.min, self.max,
         )
 
         retval = 0  # OK
@@ -78,7 +286,10 @@ class VarianceTest:
         return {
             "name": self.name,
             "return_code": retval,
-            "message": f"Variance value {sample_var:.2g}, limits [{self.min} {self.max}], sample={sample['Values'].size}",
+            "message": Message(
+                "Variance value {:.2g}, limits [{} {}], sample={}",
+                sample_var, self.min, self.max, size,
+            ),
         }
 
 
@@ -87,15 +298,17 @@ class MeanTest:
         self.min = config["Test"].get("MinAllowed", None)
         self.max = config["Test"].get("MaxAllowed", None)
         self.name = config.get("Name", "MeanTest")
+        self.chunk_size = config.get("ChunkSize", None)
 
         if self.min is None and self.max is None:
             raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
 
     def __call__(self, sample):
-        sample_mean = np.mean(sample["Values"])
+        size, sample_mean, m2 = chunked_moments(sample["Values"], self.chunk_size)
 
         logging.debug(
-            f"Executing MEAN test '{self.name}', allowed range: [{self.min} {self.max}]"
+            "Executing MEAN test '%s', allowed range: [%s %s]",
+            self.name, self.min, self.max,
         )
 
         retval = 0  # OK
@@ -108,7 +321,10 @@ class MeanTest:
         return {
             "name": self.name,
             "return_code": retval,
-            "message": f"Mean value {sample_mean:.2g}, limits [{self.min} {self.max}], sample={sample['Values'].size}",
+            "message": Message(
+                "Mean value {:.2g}, limits [{} {}], sample={}",
+                sample_mean, self.min, self.max, size,
+            ),
         }
 
 
@@ -117,21 +333,43 @@ class MissingTest:
         self.min = config["Test"].get("MinAllowed", None)
         self.max = config["Test"].get("MaxAllowed", None)
         self.name = config.get("Name", "MissingTest")
+        self.chunk_size = config.get("ChunkSize", None)
+        self.sample_size = config.get("Sample")
 
         if self.min is None and self.max is None:
             raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
 
+    def from_header(self, header):
+        """
+        Evaluate the test from the number of missing values in grib header,
+        if the sample is the whole grid. Returns None otherwise.
+        """
+
+        if "NumberOfMissing" not in header or not sample_fits(
+            self.sample_size, header["NumberOfDataPoints"], whole=True
+        ):
+            return None
+
+        return self.evaluate(header["NumberOfMissing"], header["NumberOfDataPoints"])
+
     def __call__(self, sample):
-        missing = np.ma.count_masked(sample["Values"])
+        missing = sum(
+            np.ma.count_masked(block)
+            for block in blocks(sample["Values"], self.chunk_size)
+        )
+
+        return self.evaluate(missing, sample["Values"].size)
 
+    def evaluate(self, missing, size):
         logging.debug(
-            f"Executing MISSING test '{self.name}', allowed range: [{self.min} {self.max}]"
+            "Executing MISSING test '%s', allowed range: [%s %s]",
+            self.name, self.min, self.max,
         )
 
         if "%" in str(self.min):
-            self.min = int(float(self.min[:-1]) * 0.01 * sample["Values"].size)
+            self.min = int(float(self.min[:-1]) * 0.01 * size)
         if "%" in str(self.max):
-            self.max = int(float(self.max[:-1]) * 0.01 * sample["Values"].size)
+            self.max = int(float(self.max[:-1]) * 0.01 * size)
 
         retval = 0  # OK
 
@@ -143,7 +381,10 @@ class MissingTest:
         return {
             "name": self.name,
             "return_code": retval,
-            "message": f"Number of missing values {missing:.0f}, limits [{self.min} {self.max}], sample={sample['Values'].size}",
+            "message": Message(
+                "Number of missing values {:.0f}, limits [{} {}], sample={}",
+                missing, self.min, self.max, size,
+            ),
         }
 
 
@@ -152,20 +393,599 @@ class IntegerTest:
 
     def __init__(self, config):
         self.name = config.get("Name", "IntegerTest")
+        self.chunk_size = config.get("ChunkSize", None)
 
     def __call__(self, sample):
-        arr = sample["Values"]
-
-        logging.debug(f"Executing INTEGER test '{self.name}'")
+        logging.debug("Executing INTEGER test '%s'", self.name)
 
         retval = 0  # OK
+        size = 0
 
         # Check if all elements are integers or can be safely converted to integers without losing information
-        if not np.all(np.mod(arr, 1) == 0):
+        for chunk in chunks(sample["Values"], self.chunk_size):
+            size += chunk.size
+            if not np.all(np.mod(chunk, 1) == 0):
+                retval = 1  # FAILED
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "Data {} all integers, sample={}",
+                "contained" if retval == 0 else "did not contain", size,
+            ),
+        }
+
+
+class MonotonicTest:
+    """
+    Test that values do not decrease (or increase) from the previous leadtime,
+    for example that accumulations are non-decreasing with step.
+    """
+
+    # sample contains also values of previous leadtime
+    temporal = True
+
+    def __init__(self, config):
+        self.direction = config["Test"].get("Direction", "increasing")
+        self.tolerance = config["Test"].get("Tolerance", 0)
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", 0)
+        self.name = config.get("Name", "MonotonicTest")
+        self.chunk_size = config.get("ChunkSize", None)
+
+        if self.direction not in ("increasing", "decreasing"):
+            raise ValueError("Direction must be either 'increasing' or 'decreasing'")
+
+    def __call__(self, sample):
+        if sample["Previous"] is None:
+            retval = -1  # DISABLED
+            message = Message("Test skipped, no previous leadtime")
+            return {"name": self.name, "return_code": retval, "message": message}
+
+        logging.debug(
+            "Executing MONOTONIC test '%s', direction: %s, allowed range: [%s %s]",
+            self.name, self.direction, self.min, self.max,
+        )
+
+        size = 0
+        violations = 0
+        change_min = np.nan
+
+        for values, previous in paired_chunks(
+            [sample["Values"], sample["Previous"]], self.chunk_size
+        ):
+            if values.size == 0:
+                continue
+
+            change = values - previous
+
+            if self.direction == "decreasing":
+                change = -change
+
+            size += change.size
+            violations += np.count_nonzero(change < -self.tolerance)
+            change_min = np.fmin(change_min, np.amin(change))
+
+        if "%" in str(self.min):
+            self.min = int(float(self.min[:-1]) * 0.01 * size)
+        if "%" in str(self.max):
+            self.max = int(float(self.max[:-1]) * 0.01 * size)
+
+        retval = 0  # OK
+
+        if (self.min is not None and violations < self.min) or (
+            self.max is not None and violations > self.max
+        ):
+            retval = 1  # FAILED
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "Number of values not {} from previous leadtime {} (smallest change {:.2f}), limits [{} {}], sample={}",
+                self.direction, violations, change_min, self.min, self.max, size,
+            ),
+        }
+
+
+def neighbors(field, start, stop):
+    """
+    Return values of rows start..stop of a 2-D field, and the values of their
+    neighbors above, below, left and right. Neighbors outside the field are
+    masked.
+    """
+
+    nj, ni = field.shape
+    lo = max(start - 1, 0)
+    hi = min(stop + 1, nj)
+
+    padded = np.ma.masked_all((stop - start + 2, ni + 2))
+    padded[lo - start + 1 : hi - start + 1, 1:-1] = field[lo:hi]
+
+    return (
+        padded[1:-1, 1:-1],
+        padded[:-2, 1:-1],
+        padded[2:, 1:-1],
+        padded[1:-1, :-2],
+        padded[1:-1, 2:],
+    )
+
+
+def row_blocks(field, size=None):
+    """Split a 2-D field into blocks of whole rows of about size values"""
+
+    size = CHUNK_SIZE if size is None else size
+    rows = max(1, size // field.shape[1])
+
+    for start in range(0, field.shape[0], rows):
+        yield start, min(start + rows, field.shape[0])
+
+
+class SpatialTest:
+    """
+    Count points of a 2-D field that differ from their neighbors by more than
+    MaxDifference, and test that the count is within given minimum and
+    maximum. The field is processed in blocks of rows. Subclasses define
+    which points are counted.
+    """
+
+    # test is run on whole fields instead of a sample
+    spatial = True
+
+    def __init__(self, config):
+        self.threshold = config["Test"]["MaxDifference"]
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", 0)
+        self.locations = config["Test"].get("MaxLocations", 5)
+        self.name = config.get("Name", type(self).__name__)
+        self.chunk_size = config.get("ChunkSize", None)
+
+    def __call__(self, sample):
+        # rows along j and columns along i, whichever points are consecutive
+        field = np.ma.masked_array(sample["Values"]).reshape(
+            sample["Shape"], order=sample.get("Order", "C")
+        )
+
+        logging.debug(
+            "Executing %s test '%s', max difference %s, allowed range: [%s %s]",
+            self.kind, self.name, self.threshold, self.min, self.max,
+        )
+
+        count = 0
+        locations = []
+
+        for start, stop in row_blocks(field, self.chunk_size):
+            found = self.find(*neighbors(field, start, stop))
+            count += np.count_nonzero(found)
+
+            if len(locations) < self.locations:
+                j, i = np.nonzero(found)
+                locations.extend(zip((j + start).tolist(), i.tolist()))
+
+        size = field.count()
+
+        if "%" in str(self.min):
+            self.min = int(float(self.min[:-1]) * 0.01 * size)
+        if "%" in str(self.max):
+            self.max = int(float(self.max[:-1]) * 0.01 * size)
+
+        retval = 0  # OK
+
+        if (self.min is not None and count < self.min) or (
+            self.max is not None and count > self.max
+        ):
+            retval = 1  # FAILED
+
+        where = ""
+        if count > 0:
+            where = " at (j, i) " + " ".join(
+                f"({j}, {i})" for j, i in locations[: self.locations]
+            )
+            if count > self.locations:
+                where += " ..."
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "Number of {} over {} {}{}, limits [{} {}], sample={}",
+                self.what, self.threshold, count, where, self.min, self.max, size,
+            ),
+        }
+
+
+class SpikeTest(SpatialTest):
+    """
+    Test for single point spikes: points that are higher (or lower) than
+    all of their neighbors by more than MaxDifference.
+    """
+
+    kind = "SPIKE"
+    what = "spikes"
+
+    def find(self, center, up, down, left, right):
+        diffs = [center - n for n in (up, down, left, right)]
+        valid = sum((~np.ma.getmaskarray(d)).astype(int) for d in diffs)
+
+        # missing neighbors do not prevent a spike
+        high = np.logical_and.reduce([(d > self.threshold).filled(True) for d in diffs])
+        low = np.logical_and.reduce([(d < -self.threshold).filled(True) for d in diffs])
+
+        return (high | low) & (valid >= 2) & ~np.ma.getmaskarray(center)
+
+
+class GradientTest(SpatialTest):
+    """
+    Test for sharp edges, like stripes: points whose difference to the next
+    point in the row or column is more than MaxDifference.
+    """
+
+    kind = "GRADIENT"
+    what = "neighbor differences"
+
+    def find(self, center, up, down, left, right):
+        return (abs(center - right) > self.threshold).filled(False) | (
+            abs(center - down) > self.threshold
+        ).filled(False)
+
+
+class ConsistencyTest:
+    """
+    Test that a relation between parameters, like 'DewPoint <= Temperature',
+    holds at the sampled points. All parameters are sampled at the same
+    points, and the relation is evaluated for the sampled values only.
+    """
+
+    # sample is shared by all parameters of the test
+    shared = True
+
+    def __init__(self, config):
+        self.relation = config["Test"]["Relation"]
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", 0)
+        self.name = config.get("Name", "ConsistencyTest")
+        self.code = compile(self.relation, "<relation>", "eval")
+        self.chunk_size = config.get("ChunkSize", None)
+
+    def __call__(self, sample):
+        names = list(sample["Values"])
+
+        logging.debug(
+            "Executing CONSISTENCY test '%s', relation '%s', allowed range: [%s %s]",
+            self.name, self.relation, self.min, self.max,
+        )
+
+        size = 0
+        violations = 0
+
+        for values in paired_chunks([sample["Values"][n] for n in names], self.chunk_size):
+            try:
+                holds = np.asarray(eval(self.code, {"np": np}, dict(zip(names, values))))
+            except NameError as e:
+                raise ValueError(f"Invalid relation: {self.relation}: {e}")
+
+            size += values[0].size
+            violations += values[0].size - np.count_nonzero(holds)
+
+        if "%" in str(self.min):
+            self.min = int(float(self.min[:-1]) * 0.01 * size)
+        if "%" in str(self.max):
+            self.max = int(float(self.max[:-1]) * 0.01 * size)
+
+        retval = 0  # OK
+
+        if (self.min is not None and violations < self.min) or (
+            self.max is not None and violations > self.max
+        ):
+            retval = 1  # FAILED
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "Number of values where '{}' does not hold {}, limits [{} {}], sample={}",
+                self.relation, violations, self.min, self.max, size,
+            ),
+        }
+
+
+class EnsembleSpreadTest:
+    """
+    Test that the spread of an ensemble, the standard deviation across
+    members at each sampled point averaged over the points, is within given
+    minimum and maximum. Catches collapsed ensembles, where members are
+    (nearly) identical, and exploded ones.
+    """
+
+    # sample is accumulated over the members of an ensemble
+    ensemble = True
+
+    def __init__(self, config):
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", None)
+        self.name = config.get("Name", "EnsembleSpreadTest")
+
+        if self.min is None and self.max is None:
+            raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
+
+    def __call__(self, sample):
+        n, mean, m2 = sample["Values"]
+
+        logging.debug(
+            "Executing ENSEMBLE_SPREAD test '%s', allowed range: [%s %s]",
+            self.name, self.min, self.max,
+        )
+
+        # points with less than two members have no spread
+        points = n > 1
+        size = np.count_nonzero(points)
+        spread = np.mean(np.sqrt(m2[points] / (n[points] - 1))) if size > 0 else np.nan
+
+        retval = 0  # OK
+
+        if (self.min is not None and not spread >= self.min) or (
+            self.max is not None and not spread <= self.max
+        ):
+            retval = 1  # FAILED
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "Mean ensemble spread {:.2g}, limits [{} {}], members={}, sample={}",
+                spread, self.min, self.max, sample["Members"], size,
+            ),
+        }
+
+
+class PercentileTest:
+    """
+    Test that a percentile of sample is within given minimum and maximum.
+    Large samples use a fixed-bin histogram, with number of bins given by
+    Bins.
+    """
+
+    def __init__(self, config):
+        self.percentile = config["Test"]["Percentile"]
+        self.bins = config["Test"].get("Bins", 10000)
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", None)
+        self.name = config.get("Name", "PercentileTest")
+        self.chunk_size = config.get("ChunkSize", None)
+
+        if self.min is None and self.max is None:
+            raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
+
+    def __call__(self, sample):
+        values = sample["Values"]
+        size = count_valid(values)
+
+        logging.debug(
+            "Executing PERCENTILE test '%s', percentile %s, allowed range: [%s %s]",
+            self.name, self.percentile, self.min, self.max,
+        )
+
+        if size > EXACT_LIMIT:
+            value = histogram_percentile(values, self.percentile, self.bins, self.chunk_size)
+        else:
+            value = np.percentile(np.ma.compressed(values), self.percentile)
+
+        retval = 0  # OK
+
+        if (self.min is not None and value < self.min) or (
+            self.max is not None and value > self.max
+        ):
+            retval = 1  # FAILED
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "{}th percentile {:.2f}, limits [{} {}], sample={}",
+                self.percentile, value, self.min, self.max, size,
+            ),
+        }
+
+
+class HistogramTest:
+    """
+    Test that the fraction of sample values within Range [lower, upper) is
+    within given minimum and maximum. Either end of range can be null.
+    Limits are fractions, or percents if given with '%'.
+    """
+
+    def __init__(self, config):
+        self.lower, self.upper = config["Test"]["Range"]
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", None)
+        self.name = config.get("Name", "HistogramTest")
+        self.chunk_size = config.get("ChunkSize", None)
+
+        if self.lower is None and self.upper is None:
+            raise ValueError("At least one end of Range must be defined")
+
+        if self.min is None and self.max is None:
+            raise ValueError("At least one of MinAllowed or MaxAllowed must be defined")
+
+        if "%" in str(self.min):
+            self.min = float(self.min[:-1]) * 0.01
+        if "%" in str(self.max):
+            self.max = float(self.max[:-1]) * 0.01
+
+    def __call__(self, sample):
+        logging.debug(
+            "Executing HISTOGRAM test '%s', range [%s %s), allowed range: [%s %s]",
+            self.name, self.lower, self.upper, self.min, self.max,
+        )
+
+        count = 0
+        size = 0
+
+        for chunk in chunks(sample["Values"], self.chunk_size):
+            inside = np.ones(chunk.size, dtype=bool)
+            if self.lower is not None:
+                inside &= chunk >= self.lower
+            if self.upper is not None:
+                inside &= chunk < self.upper
+            count += np.count_nonzero(inside)
+            size += chunk.size
+
+        fraction = count / size if size > 0 else 0
+
+        retval = 0  # OK
+
+        if (self.min is not None and fraction < self.min) or (
+            self.max is not None and fraction > self.max
+        ):
+            retval = 1  # FAILED
+
+        return {
+            "name": self.name,
+            "return_code": retval,
+            "message": Message(
+                "Fraction of values in range [{} {}) {:.4f}, limits [{} {}], sample={}",
+                f(self.lower), f(self.upper), fraction, self.min, self.max, size,
+            ),
+        }
+
+
+@functools.lru_cache(maxsize=64)
+def open_climatology(path):
+    """
+    Open a climatology array without reading it into memory: .npy files are
+    memory-mapped and .zarr arrays are read chunk by chunk.
+    """
+
+    if path.endswith(".zarr"):
+        try:
+            import zarr
+        except ImportError as e:
+            raise ImportError(f"zarr is needed to read climatology {path}") from e
+
+        return zarr.open_array(path, mode="r")
+
+    return np.load(path, mmap_mode="r")
+
+
+def gather(arr, indices):
+    """Read values at indices from an array, in storage order"""
+
+    order = np.argsort(indices)
+    values = np.empty(indices.size, dtype=np.float64)
+
+    if isinstance(arr, np.ndarray):
+        values[order] = arr[indices[order]]
+    else:
+        values[order] = arr.vindex[indices[order]]
+
+    return values
+
+
+class ClimatologyTest:
+    """
+    Test sample values against per-gridpoint climatological mean and standard
+    deviation. Climatology file names can contain placeholders {month} (month
+    of forecast time) and {leadtime} (in hours). Only the sampled grid points
+    are read from the climatology files, one chunk at a time.
+
+    The test is skipped if there is no climatology for the month or
+    leadtime, and fails if the climatology does not match the grid.
+    """
+
+    def __init__(self, config):
+        self.mean = config["Test"]["Mean"]
+        self.std = config["Test"]["Std"]
+        self.max_z = config["Test"].get("MaxZScore", 4)
+        self.min = config["Test"].get("MinAllowed", None)
+        self.max = config["Test"].get("MaxAllowed", 0)
+        self.name = config.get("Name", "ClimatologyTest")
+        self.chunk_size = config.get("ChunkSize", None)
+
+    def __call__(self, sample):
+        leadtime = int((sample["ForecastTime"] - sample["AnalysisTime"]).total_seconds() / 3600)
+        month = sample["ForecastTime"].month
+
+        logging.debug(
+            "Executing CLIMATOLOGY test '%s', max z-score %s, allowed range: [%s %s]",
+            self.name, self.max_z, self.min, self.max,
+        )
+
+        paths = [x.format(month=month, leadtime=leadtime) for x in (self.mean, self.std)]
+
+        for path in paths:
+            if not os.path.exists(path):
+                return {
+                    "name": self.name,
+                    "return_code": -1,  # DISABLED
+                    "message": Message("Test skipped, climatology {} not found", path),
+                }
+
+        mean, std = [open_climatology(path) for path in paths]
+
+        values = sample["Values"]
+        indices = sample["Indices"]
+        grid_size = sample.get("GridSize", values.size)
+
+        for path, arr in zip(paths, (mean, std)):
+            if arr.shape != (grid_size,):
+                return {
+                    "name": self.name,
+                    "return_code": 1,  # FAILED
+                    "message": Message(
+                        "Climatology {} has shape {}, grid has {} points",
+                        path, arr.shape, grid_size,
+                    ),
+                }
+        chunk_size = CHUNK_SIZE if self.chunk_size is None else self.chunk_size
+
+        size = 0
+        exceeding = 0
+        z_max = np.nan
+
+        for start in range(0, values.size, chunk_size):
+            stop = start + chunk_size
+            v = values[start:stop]
+
+            if indices is None:
+                # sample is the whole grid
+                m = np.asarray(mean[start:stop], dtype=np.float64)
+                s = np.asarray(std[start:stop], dtype=np.float64)
+            else:
+                m = gather(mean, indices[start:stop])
+                s = gather(std, indices[start:stop])
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                z = np.abs(np.ma.getdata(v) - m) / s
+
+            # points where value or climatology is missing, or value equals
+            # mean with zero std
+            z = z[~np.ma.getmaskarray(v) & ~np.isnan(z)]
+
+            if z.size == 0:
+                continue
+
+            size += z.size
+            exceeding += np.count_nonzero(z > self.max_z)
+            z_max = np.fmax(z_max, np.amax(z))
+
+        if "%" in str(self.min):
+            self.min = int(float(self.min[:-1]) * 0.01 * size)
+        if "%" in str(self.max):
+            self.max = int(float(self.max[:-1]) * 0.01 * size)
+
+        retval = 0  # OK
+
+        if (self.min is not None and exceeding < self.min) or (
+            self.max is not None and exceeding > self.max
+        ):
             retval = 1  # FAILED
 
         return {
             "name": self.name,
             "return_code": retval,
-            "message": f"Data {'contained' if retval == 0 else 'did not contain'} all integers, sample={arr.size}",
+            "message": Message(
+                "Number of values with z-score over {} {} (max z-score {:.2f}), limits [{} {}], sample={}",
+                self.max_z, exceeding, z_max, self.min, self.max, size,
+            ),
         }
@@ -1,10 +1,30 @@
 #!/usr/bin/env python3
 
-import importlib
+import io
+import json
+import logging
+import subprocess
 import sys
 import pytest
 import os
-from grid_check import check, parse_configuration_file, index_grib_files
+import numpy as np
+from grid_check.client import CheckRequestError, request_check
+from grid_check.results import Message, Summary, report, to_json
+from grid_check.server import CheckService, serve
+from grid_check.fileutils import GridCache
+from grid_check.tests import histogram_percentile
+from grid_check import (
+    check,
+    check_batch,
+    check_shard,
+    check_stream,
+    compile_demand,
+    compile_plans,
+    execute_plans,
+    merge_shards,
+    parse_configuration_file,
+    index_grib_files,
+)
 
 import_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, import_dir)
@@ -129,3 +149,1124 @@ def test_include():
     }
 
     assert check(config, dims, index_grib_files(files)) == 1
+
+
+def test_stream(tmp_path, caplog):
+    import eccodes
+
+    config = "pcp.yaml"
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        config, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    with open("pcp.grib2", "rb") as fp:
+        assert check_stream(config, dims, fp) == 0
+
+    with open("pcp.grib2", "rb") as fp:
+        assert check_stream(config, dims, fp, strict=True) == 1
+
+    # results are reported in the same order as from files, whatever the
+    # order of messages in the stream
+    reversed_file = str(tmp_path / "reversed.grib2")
+    messages = []
+
+    with open("pcp.grib2", "rb") as fp:
+        while (gid := eccodes.codes_grib_new_from_file(fp)) is not None:
+            messages.append(eccodes.codes_get_message(gid))
+            eccodes.codes_release(gid)
+
+    with open(reversed_file, "wb") as fp:
+        fp.write(b"".join(reversed(messages)))
+
+    def reported(run):
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            run()
+        # samples are random, compare what was tested only
+        return [
+            r.getMessage().partition("): ")[0] for r in caplog.records if r.filename == "results.py"
+        ]
+
+    expected = reported(lambda: check(config, dims, index_grib_files([["pcp.grib2"]])))
+
+    with open(reversed_file, "rb") as fp:
+        assert reported(lambda: check_stream(config, dims, fp)) == expected
+
+
+def test_demand():
+    config = "pcp.yaml"
+    files = [["pcp.grib2"]]
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        config, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    demand = compile_demand(config, dims)
+
+    # leadtimes 3, 6, 9, 12 and lagged -3 (which does not exist) and 0
+    assert len(demand) == 6
+
+    index = index_grib_files(files, demand)
+
+    assert check(config, dims, index) == 0
+
+
+def test_plans():
+    config = "pcp.yaml"
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        config, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    plans = compile_plans(config, dims)
+
+    assert len(plans) == 1
+
+    test, units = plans[0]
+
+    assert len(units) == len(forecast_types) * len(leadtimes)
+
+    ft, lt, keys = units[0]
+    keys = dict(keys)
+
+    # endStep is the second last index key
+    assert keys["Precipitation"][-2] == 3
+    assert keys["Precipitation_lagged"][-2] == -3
+
+
+def test_batch():
+    files = [["pcp.grib2", "tstm.grib2"]]
+    configurations = []
+
+    for configfile in ["pcp.yaml", "tstm.yaml"]:
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            configfile, None
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        configurations.append((configfile, config, dims))
+
+    assert check_batch(configurations, files) == {"pcp.yaml": 0, "tstm.yaml": 1}
+
+
+def test_service():
+    files = ["pcp.grib2", "tstm.grib2"]
+    configurations = []
+
+    for configfile in ["pcp.yaml", "tstm.yaml"]:
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            configfile, None
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        configurations.append((configfile, config, dims))
+
+    service = CheckService(configurations)
+
+    assert service.check("pcp.yaml", files)["return_code"] == 0
+    assert service.check("tstm.yaml", files)["return_code"] == 1
+
+    index, cache = service.open_input(files)
+    decoded = cache.decoded
+
+    # grids are kept warm between checks
+    ret = service.check("pcp.yaml", files, strict=True)
+
+    assert ret["return_code"] == 1
+    assert ret["skip"] == 1
+    assert cache.decoded == decoded
+
+    # sample orders are kept warm between checks
+    orders = dict(service.orders.orders)
+    assert len(orders) > 0
+    service.check("pcp.yaml", files)
+    assert all(service.orders.orders[size] is order for size, order in orders.items())
+
+    with pytest.raises(KeyError, match="Unknown configuration"):
+        service.check("unknown.yaml", files)
+
+    # decoded grids of all inputs share one budget
+    service = CheckService(configurations, max_grids=2)
+    service.check("pcp.yaml", files)
+    service.check("pcp.yaml", files[:1])
+
+    assert len(service.retained) == 2
+
+
+def test_service_errors():
+    import http.client
+    import threading
+    from grid_check.server import CheckRequestHandler, TCPCheckServer
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file("pcp.yaml", None)
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    server = TCPCheckServer(("127.0.0.1", 0), CheckRequestHandler)
+    server.service = CheckService([("pcp.yaml", config, dims)])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def post(body):
+        conn = http.client.HTTPConnection(*server.server_address)
+        try:
+            conn.request("POST", "/check", json.dumps(body))
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read())["error"]
+        finally:
+            conn.close()
+
+    try:
+        assert post({"configuration": "unknown.yaml", "files": []}) == (
+            400, "Unknown configuration: unknown.yaml"
+        )
+        assert post({"files": []}) == (400, "Missing fields in request: configuration")
+
+        # other errors are errors of the service
+        status, error = post({"configuration": "pcp.yaml", "files": 1})
+        assert status == 500
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_service_address(tmp_path):
+    # service is not reachable from other hosts unless asked for
+    with pytest.raises(ValueError, match="non-loopback"):
+        serve("0.0.0.0:0", [])
+
+    with pytest.raises(CheckRequestError, match="Unable to connect"):
+        request_check(f"unix:{tmp_path / 'missing.sock'}", "pcp.yaml", ["pcp.grib2"])
+
+
+def test_lazy_imports():
+    # heavy modules must not be imported before they are needed
+    code = "import sys, grid_check; print(' '.join(sorted(sys.modules)))"
+    modules = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout.split()
+
+    for m in ["eccodes", "gribapi", "fsspec", "pydash"]:
+        assert m not in modules
+
+    # client of the check service does not need numpy or yaml
+    code = (
+        "import sys, grid_check.client, grid_check.results; "
+        "print(' '.join(sorted(sys.modules)))"
+    )
+    modules = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True
+    ).stdout.split()
+
+    for m in ["numpy", "yaml", "eccodes"]:
+        assert m not in modules
+
+
+def test_climatology(tmp_path):
+    configfile = "climatology.yaml"
+    files = [["pcp.grib2"]]
+
+    # grid of pcp.grib2 has 74806 points, data is from May
+    for lt in [3, 6, 9, 12]:
+        np.save(tmp_path / f"pcp_mean_05_{lt}h.npy", np.full(74806, 2.0))
+    np.save(tmp_path / "pcp_std_05.npy", np.full(74806, 10.0))
+
+    def run(std):
+        patch = [
+            f"Tests[0].Test.Mean={tmp_path}/pcp_mean_{{month:02d}}_{{leadtime}}h.npy",
+            f"Tests[0].Test.Std={tmp_path}/{std}",
+        ]
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            configfile, patch
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        return check(config, dims, index_grib_files(files))
+
+    assert run("pcp_std_{month:02d}.npy") == 0
+
+    # with small deviation most precipitating points are anomalous
+    np.save(tmp_path / "pcp_std_small.npy", np.full(74806, 0.1))
+    assert run("pcp_std_small.npy") == 1
+
+    # climatology of another grid is an error, missing climatology is skipped
+    np.save(tmp_path / "pcp_std_other.npy", np.full(1000, 10.0))
+    assert run("pcp_std_other.npy") == 1
+    assert run("pcp_std_missing.npy") == 0
+
+
+def test_monotonic():
+    configfile = "monotonic.yaml"
+    files = [["pcp.grib2"]]
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    assert check(config, dims, index_grib_files(files)) == 0
+
+    # accumulation is decreasing in every point where it has rained
+    patch = ["Tests[0].Test.Direction=decreasing"]
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, patch
+    )
+
+    assert check(config, dims, index_grib_files(files)) == 1
+
+
+def test_window():
+    configfile = "monotonic.yaml"
+    files = [["pcp.grib2"]]
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    cache = GridCache()
+    execute_plans([compile_plans(config, dims)], index_grib_files(files), cache)
+
+    # previous and lagged grids are served from memory: each of the five
+    # messages is decoded once, and only a few are kept at a time
+    assert cache.decoded == 5
+    assert cache.reused > 0
+    assert cache.peak <= 3
+
+
+def test_percentile():
+    configfile = "percentile.yaml"
+    files = [["pcp.grib2"]]
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    assert check(config, dims, index_grib_files(files)) == 0
+
+    patch = ["Tests[0].Test[0].MaxAllowed=10", "Tests[0].Test[1].MaxAllowed=0.1%"]
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, patch
+    )
+
+    assert check(config, dims, index_grib_files(files)) == 1
+
+
+def test_histogram_percentile():
+    values = np.random.gamma(0.5, 4.0, 200000)
+    bins = 5000
+    width = (values.max() - values.min()) / bins
+
+    for q in [1, 50, 99, 99.9]:
+        assert abs(histogram_percentile(values, q, bins) - np.percentile(values, q)) <= width
+        assert histogram_percentile(values, q, bins, 1000) == histogram_percentile(values, q, bins)
+
+
+def test_chunked():
+    configfile = "chunked.yaml"
+    files = [["pcp.grib2"]]
+
+    def run(patch):
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            configfile, patch
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        plans = compile_plans(config, dims)
+        return execute_plans([plans], index_grib_files(files))[0]
+
+    # grid of pcp.grib2 has 74806 points, evaluated in one chunk by default
+    whole = run(None)
+    chunked = run(["Tests[0].ChunkSize=1000"])
+
+    assert [r["summary"] for r in whole] == [r["summary"] for r in chunked]
+    assert sum(r["success"] for r in chunked) > 0
+
+
+def test_shard(tmp_path):
+    # whole grid samples, so that results do not depend on sampling
+    configurations = []
+    for name in ["chunked.yaml", "percentile.yaml"]:
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            name, None
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+        configurations.append((name, config, dims))
+
+    files = [["pcp.grib2"]]
+
+    all_plans = [compile_plans(config, dims) for name, config, dims in configurations]
+    whole = execute_plans(all_plans, index_grib_files(files))
+
+    partials = [check_shard(configurations, files, i, 3) for i in range(3)]
+
+    # every shard got some of the work
+    for p in partials:
+        assert any(
+            r is not None for c in p["configurations"] for t in c["results"] for r in t
+        )
+
+    merged = merge_shards(partials)
+
+    assert [name for name, results in merged] == ["chunked.yaml", "percentile.yaml"]
+    assert [results for name, results in merged] == whole
+
+    with pytest.raises(ValueError):
+        merge_shards(partials[:2])
+
+    # shards get contiguous ranges of leadtimes, so that temporal tests read
+    # the previous leadtime in the same shard except at the boundary
+    from grid_check.check import assign_shards
+
+    shards = assign_shards(all_plans, 2)
+    leadtimes = [
+        sorted(set(all_plans[c][p][1][u][1] for (c, p, u), s in shards.items() if s == shard))
+        for shard in range(2)
+    ]
+
+    assert len(leadtimes[0]) > 0 and len(leadtimes[1]) > 0
+    assert max(leadtimes[0]) <= min(leadtimes[1])
+
+    # partial results written as json merge to the same results
+    loaded = [json.loads(json.dumps(p, default=to_json)) for p in partials]
+
+    assert [results for name, results in merge_shards(loaded)] == whole
+
+    # same with independent processes
+    script = os.path.join(import_dir, "grid-check.py")
+    procs = [
+        subprocess.Popen(
+            [sys.executable, script, "-c", "chunked.yaml", "--shard", f"{i}/2",
+             "--output", str(tmp_path / f"{i}.json"), "pcp.grib2"]
+        )
+        for i in range(2)
+    ]
+
+    assert [p.wait() for p in procs] == [0, 0]
+
+    merge = subprocess.run(
+        [sys.executable, script, "merge", str(tmp_path / "0.json"), str(tmp_path / "1.json")]
+    )
+
+    # chunked.yaml has a failing INTEGER test
+    assert merge.returncode == 1
+
+
+def test_index_files(tmp_path, caplog):
+    import eccodes
+    from grid_check.constants import INDEX_KEYS
+
+    scanned = index_grib_files([["pcp.grib2"]])
+
+    grib_file = str(tmp_path / "pcp.grib2")
+    with open("pcp.grib2", "rb") as src, open(grib_file, "wb") as dst:
+        dst.write(src.read())
+
+    def same_messages(index):
+        return {k: (v["offset"], v["length"]) for k, v in index.items()} == {
+            k: (v["offset"], v["length"]) for k, v in scanned.items()
+        }
+
+    # wgrib2 style inventory with key=value fields next to the grib file
+    with open(grib_file + ".idx", "w") as fp:
+        for i, (key, entry) in enumerate(sorted(scanned.items(), key=lambda x: x[1]["offset"])):
+            fields = " ".join(f"{k}={'undef' if v is None else v}" for k, v in zip(INDEX_KEYS, key))
+            fp.write(f"{i + 1}:{entry['offset']}:d=2020051312:{fields}:\n")
+
+    assert same_messages(index_grib_files([[grib_file]]))
+
+    # plain inventory without index keys is not usable, file is scanned.
+    # That is a warning only if the inventory was given explicitly
+    with open(grib_file + ".idx", "w") as fp:
+        fp.write("1:0:d=2020051312:APCP:surface:0-3 hour acc fcst:\n")
+
+    with caplog.at_level(logging.WARNING):
+        assert same_messages(index_grib_files([[grib_file]]))
+        assert "Unable to use index file" not in caplog.text
+
+        assert same_messages(index_grib_files([[grib_file]], None, [grib_file + ".idx"]))
+        assert "Unable to use index file" in caplog.text
+
+    # inventory written by wgrib2 -s -varX does not have level, forecast time
+    # or ensemble member as keys, file is scanned
+    with open(grib_file + ".idx", "w") as fp:
+        fp.write(
+            "1:0:d=2020051312:APCP:surface:0-3 hour acc fcst::"
+            "var discipline=0 center=86 local_table=0 parmcat=1 parm=8\n"
+        )
+
+    assert same_messages(index_grib_files([[grib_file]]))
+
+    # eccodes index given explicitly, read only for the demanded messages
+    idx = eccodes.codes_index_new_from_file(grib_file, [k + ":l" for k in INDEX_KEYS])
+    eccodes.codes_index_write(idx, str(tmp_path / "pcp.gribidx"))
+    eccodes.codes_index_release(idx)
+
+    demand = set(list(scanned)[:2])
+    index = index_grib_files([[grib_file]], demand, [str(tmp_path / "pcp.gribidx")])
+
+    assert set(index) == demand
+    assert all(index[k]["offset"] == scanned[k]["offset"] for k in demand)
+    # messages were located through the index, not by scanning
+    assert all(index[k]["message_no"] is None for k in demand)
+
+
+def test_header(monkeypatch, tmp_path):
+    from grid_check.tests import MissingTest
+
+    files = [["missing.grib2"]]
+
+    def run(patch):
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            "missing.yaml", patch
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        cache = GridCache(pool=pool)
+        results = execute_plans([compile_plans(config, dims)], index_grib_files(files), cache)
+        return results[0][0], cache
+
+    pool = None
+
+    # number of missing values is in header of ccsds packed grid
+    header, cache = run(None)
+    assert (cache.decoded, cache.avoided) == (0, 1)
+
+    monkeypatch.delattr(MissingTest, "from_header")
+    decoded, cache = run(None)
+    assert cache.decoded == 1
+    assert header == decoded
+    monkeypatch.undo()
+
+    # values are packed with 4 bits: header bounds are [0 15]
+    envelope = ["Tests[0].Test.Type=ENVELOPE", "Tests[0].Test.MinAllowed=0"]
+
+    ret, cache = run(envelope + ["Tests[0].Test.MaxAllowed=20"])
+    assert (ret["success"], cache.decoded, cache.avoided) == (1, 0, 1)
+
+    ret, cache = run(envelope + ["Tests[0].Test.MaxAllowed=20", "Tests[0].Sample=1000"])
+    assert ret["summary"][0]["message"].endswith("sample=1000")
+
+    ret, cache = run(envelope + ["Tests[0].Test.MaxAllowed=10"])
+    assert cache.decoded == 1
+
+    # header is parsed from the sections before the data, and the rest of the
+    # message is read only if it must be decoded after all
+    from grid_check.decode import DecodePool
+    from grid_check.fileutils import read_data, read_head, read_header
+
+    grid = next(iter(index_grib_files(files).values()))
+    head = read_head(grid)
+
+    with open(grid["file_name"], "rb") as fp:
+        fp.seek(grid["offset"])
+        message = fp.read(grid["length"])
+
+    assert len(head) < grid["length"]
+    assert read_header(grid, head) == read_header({"message": message})
+    assert np.ma.allequal(read_data({**grid, "head": head})["Values"], read_data(grid)["Values"])
+
+    # head of a truncated message is not read, the message is read whole
+    truncated = str(tmp_path / "truncated.grib2")
+
+    with open(truncated, "wb") as fp:
+        fp.write(message[: len(head) + 3])
+
+    grid = {**grid, "file_name": truncated, "offset": 0}
+
+    assert read_head(grid) is None
+
+    # grids of tests not decided from the headers are prefetched, not decoded
+    # when they are read
+    expected, cache = run(envelope + ["Tests[0].Test.MaxAllowed=10"])
+    pool = DecodePool(1)
+    monkeypatch.setattr(pool, "decode", None)
+    try:
+        ret, cache = run(envelope + ["Tests[0].Test.MaxAllowed=10"])
+        assert ret == expected
+        assert (cache.decoded, len(cache.pending)) == (1, 0)
+    finally:
+        pool.close()
+
+
+def pcp_fields():
+    """Index of pcp.grib2, its keys ordered by step and their values as 2-D fields"""
+
+    from grid_check.constants import INDEX_KEYS
+    from grid_check.fileutils import read_data
+
+    index = index_grib_files([["pcp.grib2"]])
+    keys = sorted(index, key=lambda k: k[INDEX_KEYS.index("endStep")])
+    fields = [
+        np.ma.filled(read_data(index[key])["Values"], np.nan).reshape(226, 331) for key in keys
+    ]
+
+    return index, keys, fields
+
+
+def run_chunked(files):
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        "chunked.yaml", None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    return execute_plans([compile_plans(config, dims)], index_grib_files(files))[0]
+
+
+def test_zarr(tmp_path):
+    import zarr
+    from grid_check.check import sample_lazy
+    from grid_check.constants import INDEX_KEYS
+    from grid_check.fileutils import read_data
+
+    # same data as pcp.grib2, as a zarr store with cfgrib style attributes
+    index, keys, fields = pcp_fields()
+
+    store = str(tmp_path / "pcp.zarr")
+    group = zarr.open_group(store, mode="w")
+    arr = group.create_array(
+        "pcp", shape=(len(keys), 226, 331), chunks=(1, 64, 64), dtype="f8",
+        dimension_names=("step", "y", "x"),
+    )
+    # missing points are NaN, and dry points 0 which is also the default fill
+    # value of zarr
+    for i, field in enumerate(fields):
+        arr[i] = field
+
+    for k, v in zip(INDEX_KEYS, keys[0]):
+        if k != "endStep":
+            arr.attrs[f"GRIB_{k}"] = v
+    group.attrs["GRIB_dataDate"] = 20200513
+    group.attrs["GRIB_dataTime"] = 1200
+
+    step = group.create_array("step", shape=(len(keys),), dtype="i8", dimension_names=("step",))
+    step[:] = [k[INDEX_KEYS.index("endStep")] for k in keys]
+
+    zarr_index = index_grib_files([[store]])
+
+    assert set(zarr_index) == set(index)
+    assert run_chunked([[store]]) == run_chunked([["pcp.grib2"]])
+
+    # small sample reads only some of the chunks
+    values = read_data(zarr_index[keys[1]])["Values"]
+    indices, sample = sample_lazy(values, 20)
+
+    assert sample.size == 20 and np.all(sample >= 0)
+    assert values.chunks_read < 4 * 6
+    assert np.array_equal(values.read()[indices], sample)
+
+
+def test_zarr_fill_value(tmp_path):
+    import zarr
+    from grid_check.fileutils import read_data
+
+    # zarr arrays have fill value 0 unless set, zeros are valid values
+    group = zarr.open_group(str(tmp_path / "int.zarr"), mode="w")
+    group.attrs["GRIB_dataDate"] = 20200513
+
+    for name, attrs in [("plain", {}), ("declared", {"_FillValue": 15})]:
+        arr = group.create_array(name, shape=(4, 4), dtype="f8", dimension_names=("y", "x"))
+        arr[:] = np.arange(16.0).reshape(4, 4)
+        arr.attrs.update(
+            {"GRIB_discipline": 0, "GRIB_parameterCategory": 1, "GRIB_parameterNumber": 8, **attrs}
+        )
+        arr.attrs["GRIB_typeOfFirstFixedSurface"] = len(name)
+
+    index = index_grib_files([[str(tmp_path / "int.zarr")]])
+    values = {g["variable"]: read_data(g)["Values"].read() for g in index.values()}
+
+    assert values["plain"].count() == 16 and values["plain"][0] == 0
+    assert values["declared"].count() == 15 and values["declared"][15] is np.ma.masked
+
+
+def test_netcdf(tmp_path):
+    netCDF4 = pytest.importorskip("netCDF4")
+    from grid_check.check import sample_lazy
+    from grid_check.constants import INDEX_KEYS
+    from grid_check.fileutils import read_data
+
+    # same data as pcp.grib2, as a netcdf file with cfgrib style attributes
+    index, keys, fields = pcp_fields()
+
+    path = str(tmp_path / "pcp.nc")
+
+    with netCDF4.Dataset(path, mode="w") as ds:
+        ds.createDimension("step", len(keys))
+        ds.createDimension("y", 226)
+        ds.createDimension("x", 331)
+
+        step = ds.createVariable("step", "i8", ("step",))
+        step[:] = [k[INDEX_KEYS.index("endStep")] for k in keys]
+
+        var = ds.createVariable(
+            "pcp", "f8", ("step", "y", "x"), chunksizes=(1, 64, 64), fill_value=np.nan
+        )
+        for i, field in enumerate(fields):
+            var[i] = field
+
+        for k, v in zip(INDEX_KEYS, keys[0]):
+            if k != "endStep" and v is not None:
+                var.setncattr(f"GRIB_{k}", v)
+        ds.setncattr("GRIB_dataDate", 20200513)
+        ds.setncattr("GRIB_dataTime", 1200)
+
+    netcdf_index = index_grib_files([[path]])
+
+    assert set(netcdf_index) == set(index)
+    assert run_chunked([[path]]) == run_chunked([["pcp.grib2"]])
+
+    values = read_data(netcdf_index[keys[1]])["Values"]
+    indices, sample = sample_lazy(values, 20)
+
+    assert values.chunks_read < 4 * 6
+    assert np.array_equal(values.read()[indices], sample)
+
+
+def test_spatial():
+    from grid_check.tests import GradientTest, SpikeTest
+
+    configfile = "spatial.yaml"
+    files = [["pcp.grib2"]]
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    assert check(config, dims, index_grib_files(files)) == 0
+
+    patch = ["Tests[0].Test[0].MaxDifference=0.5", "Tests[0].Test[1].MaxDifference=0.5"]
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        configfile, patch
+    )
+
+    assert check(config, dims, index_grib_files(files)) == 1
+
+    # a spike at a block boundary and a stripe, in blocks of two rows
+    field = np.zeros((6, 5))
+    field[1, 0] = 10
+    field[4, :] = 3
+    values = np.ma.masked_array(field.ravel(), mask=False)
+    values[2] = np.ma.masked
+    sample = {"Values": values, "Shape": (6, 5)}
+
+    config = {"Test": {"MaxDifference": 2}, "ChunkSize": 10}
+
+    ret = SpikeTest(config)(sample)
+    assert ret["return_code"] == 1
+    assert "spikes over 2 1 at (j, i) (1, 0)," in str(ret["message"])
+
+    # stripe edges above and below, and the spike to the right and below
+    ret = GradientTest(config)(sample)
+    assert "differences over 2 12 " in str(ret["message"])
+
+    # with j points consecutive, the values are in column order, and
+    # locations are still (j, i)
+    columns = np.ma.masked_array(field.ravel(order="F"), mask=False)
+    ret = SpikeTest(config)({"Values": columns, "Shape": (6, 5), "Order": "F"})
+    assert "spikes over 2 1 at (j, i) (1, 0)" in str(ret["message"])
+
+    # spatial tests are run on grids as they are
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(configfile, None)
+    config["Tests"][0]["Test"][0]["Preprocess"] = {"Function": "Temperature * 2"}
+
+    with pytest.raises(ValueError, match="Preprocess cannot be used with SPIKE test"):
+        compile_plans(config, dims)
+
+
+def test_consistency():
+    configfile = "consistency.yaml"
+    files = [["pcp.grib2"]]
+
+    def run(patch):
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            configfile, patch
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        return execute_plans([compile_plans(config, dims)], index_grib_files(files))[0][0]
+
+    # lagged precipitation is missing for the first leadtime
+    ret = run(None)
+    assert (ret["success"], ret["fail"], ret["skip"]) == (3, 0, 1)
+    assert "Precipitation, Precipitation_lagged for" in ret["summary"][0]["message"]
+
+    ret = run(["Tests[0].Test.Relation=Precipitation_lagged > Precipitation"])
+    assert (ret["success"], ret["fail"]) == (0, 3)
+
+    # whole grids, evaluated in chunks
+    whole = ["Tests[0].Sample=100%", "Tests[0].ChunkSize=1000"]
+    ret = run(whole)
+    assert (ret["success"], ret["fail"], ret["skip"]) == (3, 0, 1)
+
+    ret = run(whole + ["Tests[0].Test.Relation=Precipitation_lagged > Precipitation"])
+    assert (ret["success"], ret["fail"]) == (0, 3)
+
+
+def test_decode_pool():
+    import gc
+    from grid_check.decode import DecodePool
+    from grid_check.fileutils import read_data
+
+    index = index_grib_files([["pcp.grib2"]])
+    pool = DecodePool(2)
+
+    try:
+        for key, grid in index.items():
+            expected = read_data(grid)
+            data = pool.decode(grid)
+
+            assert np.array_equal(data["Values"], expected["Values"])
+            assert data["Shape"] == expected["Shape"]
+            assert data["ForecastTime"] == expected["ForecastTime"]
+
+        # buffers are sized before decoding, and recycled once the arrays
+        # using them are gone: one for the current and one for the previous
+        # grid
+        del data
+        gc.collect()
+        assert len(pool.buffers) == 2
+        assert len(pool.free) == 2
+
+        config, forecast_types, leadtimes, parameters = parse_configuration_file(
+            "chunked.yaml", None
+        )
+
+        dims = {
+            "forecast_types": forecast_types,
+            "leadtimes": leadtimes,
+            "parameters": parameters,
+        }
+
+        plans = compile_plans(config, dims)
+        cache = GridCache(pool=pool)
+
+        assert execute_plans([plans], index, cache) == execute_plans([plans], index)
+        assert cache.decoded == len(index) - 1
+    finally:
+        pool.close()
+
+
+def test_sparse(tmp_path):
+    import eccodes
+    from grid_check.check import read_sample, read_shared_sample
+    from grid_check.fileutils import PackedValues, read_data
+
+    # same data as missing.grib2, with simple packing
+    with open("missing.grib2", "rb") as fp:
+        gid = eccodes.codes_grib_new_from_file(fp)
+
+    data = eccodes.codes_get_values(gid)
+    eccodes.codes_set_string(gid, "packingType", "grid_simple")
+    eccodes.codes_set_values(gid, data)
+    simple = str(tmp_path / "simple.grib2")
+
+    with open(simple, "wb") as fp:
+        eccodes.codes_write(gid, fp)
+    eccodes.codes_release(gid)
+
+    grid = next(iter(index_grib_files([[simple]]).values()))
+    values = read_data(grid)["Values"]
+    expected = read_data(next(iter(index_grib_files([["missing.grib2"]]).values())))["Values"]
+
+    assert isinstance(values, PackedValues)
+    assert values.valid_size == expected.count()
+
+    indices = np.random.choice(values.size, 10000, replace=False)
+    sample = values.take(indices)
+
+    assert np.array_equal(np.ma.getmaskarray(sample), np.ma.getmaskarray(expected)[indices])
+    assert np.array_equal(sample.compressed(), expected[indices].compressed())
+
+    # small samples are unpacked point by point, large ones decoded whole
+    values = read_data(grid)["Values"]
+    sample = read_sample([{"Values": values}], "1%")[0]
+
+    assert values.values is None
+    assert sample["Values"].size == values.valid_size // 100
+    assert np.array_equal(sample["Values"], expected[sample["Indices"]])
+
+    sample = read_sample([{"Values": values}], "50%")[0]
+
+    assert values.values is not None
+    assert sample["Values"].size == values.valid_size // 2
+
+    # shared samples are read point by point too, and only at points that
+    # are valid in all grids
+    grids = [{"Parameter": p, "Values": read_data(grid)["Values"]} for p in ["a", "b"]]
+    sample = read_shared_sample(grids, 1000)[0]
+
+    assert all(g["Values"].values is None for g in grids)
+    assert sample["Indices"].size == np.unique(sample["Indices"]).size == 1000
+    assert not np.any(np.ma.getmaskarray(expected)[sample["Indices"]])
+    assert np.array_equal(sample["Values"]["b"], expected[sample["Indices"]])
+
+    # a sample of all valid points is taken from the combined mask, without
+    # drawing indices
+    valid = expected.count()
+    grids = [{"Parameter": p, "Values": read_data(grid)["Values"]} for p in ["a", "b"]]
+    sample = read_shared_sample(grids, valid)[0]
+
+    assert sample["Indices"] is None
+    assert sample["Values"]["a"].count() == valid
+    assert read_shared_sample(grids, valid + 1) == [None]
+
+    sample = read_shared_sample(grids, valid - 10)[0]
+
+    assert sample["Indices"].size == np.unique(sample["Indices"]).size == valid - 10
+    assert not np.any(np.ma.getmaskarray(expected)[sample["Indices"]])
+
+
+def test_ensemble(tmp_path, caplog):
+    import eccodes
+
+    def write_members(spread):
+        # pcp.grib2 is the control member, perturbed members are shifted
+        members = str(tmp_path / "members.grib2")
+
+        with open("pcp.grib2", "rb") as fp, open(members, "wb") as out:
+            while True:
+                gid = eccodes.codes_grib_new_from_file(fp)
+                if gid is None:
+                    break
+
+                eccodes.codes_write(gid, out)
+                values = eccodes.codes_get_values(gid)
+
+                for m in range(1, 5):
+                    clone = eccodes.codes_clone(gid)
+                    eccodes.codes_set(clone, "typeOfProcessedData", 4)
+                    eccodes.codes_set(clone, "perturbationNumber", m)
+                    eccodes.codes_set_values(clone, values + m * spread)
+                    eccodes.codes_write(clone, out)
+                    eccodes.codes_release(clone)
+
+                eccodes.codes_release(gid)
+
+        return members
+
+    config, forecast_types, leadtimes, parameters = parse_configuration_file(
+        "ensemble.yaml", None
+    )
+
+    dims = {
+        "forecast_types": forecast_types,
+        "leadtimes": leadtimes,
+        "parameters": parameters,
+    }
+
+    plans = compile_plans(config, dims)
+
+    # one unit for each leadtime, with all members
+    assert [len(units) for test, units in plans] == [4]
+    assert len(plans[0][1][0][2]) == 5
+
+    index = index_grib_files([[write_members(1.0)]])
+    ret = execute_plans([plans], index)[0][0]
+
+    assert (ret["success"], ret["fail"], ret["skip"]) == (4, 0, 0)
+    assert "perturbationNumber=0-4" in ret["summary"][0]["message"]
+    assert "members=5" in ret["summary"][0]["message"]
+
+    # collapsed ensemble
+    index = index_grib_files([[write_members(0.0)]])
+    ret = execute_plans([plans], index)[0][0]
+
+    assert (ret["success"], ret["fail"]) == (0, 4)
+
+    # with a test of each member, members are not kept for the ensemble
+    mean = compile_plans(
+        {"Tests": [{**config["Tests"][0], "Test": {"Type": "MEAN", "MinAllowed": -1}}]}, dims
+    )
+    cache = GridCache()
+    ret = execute_plans([plans, mean], index, cache)
+
+    assert (ret[0][0]["fail"], ret[1][0]["success"]) == (4, 20)
+    assert cache.peak == 1
+
+    # a member missing from a stream, the ensemble is evaluated without it
+    messages = []
+
+    with open(write_members(1.0), "rb") as fp:
+        while (gid := eccodes.codes_grib_new_from_file(fp)) is not None:
+            step = eccodes.codes_get(gid, "endStep")
+            if (step, eccodes.codes_get(gid, "perturbationNumber")) != (3, 1):
+                messages.append(eccodes.codes_get_message(gid))
+            eccodes.codes_release(gid)
+
+    with caplog.at_level(logging.INFO):
+        assert check_stream(config, dims, io.BytesIO(b"".join(messages))) == 0
+
+    assert caplog.text.count("members=4") == 1
+
+
+def test_configuration_cache(tmp_path, monkeypatch):
+    import shutil
+
+    cache_dir = str(tmp_path / "cache")
+
+    for f in ["include_test.yaml", "include_tstm_test.yaml"]:
+        shutil.copy(f, tmp_path)
+
+    # includes are looked up relative to working directory first
+    monkeypatch.chdir(tmp_path)
+
+    configfile = "include_test.yaml"
+    patch = ["Tests[0].Sample=10%"]
+    parsed = parse_configuration_file(configfile, patch, cache_dir)
+
+    (cache_file,) = os.listdir(cache_dir)
+
+    # cache is private to the user
+    assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+    assert os.stat(os.path.join(cache_dir, cache_file)).st_mode & 0o777 == 0o600
+
+    # cached configuration is used without parsing
+    with monkeypatch.context() as m:
+        m.setattr("yaml.load", None)
+        assert parse_configuration_file(configfile, patch, cache_dir) == parsed
+
+        # but not if others could have written it
+        os.chmod(os.path.join(cache_dir, cache_file), 0o666)
+        with pytest.raises(TypeError):
+            parse_configuration_file(configfile, patch, cache_dir)
+
+    # other patches and changed included files are parsed again
+    assert parse_configuration_file(configfile, None, cache_dir)[0]["Tests"][0]["Sample"] == "40%"
+
+    with open(tmp_path / "include_tstm_test.yaml", "a") as fp:
+        fp.write("  ChunkSize: 1000\n")
+
+    config = parse_configuration_file(configfile, patch, cache_dir)[0]
+
+    assert config["Tests"][0]["Sample"] == "10%"
+    assert config["Tests"][0]["ChunkSize"] == 1000
+
+
+def test_messages(caplog):
+    from datetime import datetime, timedelta
+
+    class Value:
+        formatted = 0
+
+        def __format__(self, spec):
+            Value.formatted += 1
+            return format(1.5, spec)
+
+    # messages are formatted only when rendered
+    message = Message(
+        "Min and max [{:.2f} {:.2f}], limits [{} {}], sample={}", Value(), 2, 0, 10, 100
+    )
+    ft = [{"Key": "typeOfProcessedData", "Value": 3}, {"Key": "perturbationNumber", "Value": 0}]
+    summary = Summary(
+        "check pcp", 0, message, "Precipitation", datetime(2020, 5, 13, 12),
+        datetime(2020, 5, 13, 18), timedelta(hours=6), ft,
+    )
+
+    assert Value.formatted == 0
+
+    # with the same text as formatted eagerly
+    text = (
+        "Forecast type: typeOfProcessedData=3 perturbationNumber=0 Precipitation for "
+        "2020-05-13 12:00:00 +6h (2020-05-13 18:00:00): "
+        "Min and max [1.50 2.00], limits [0 10], sample=100"
+    )
+
+    assert json.loads(json.dumps(summary, default=to_json)) == {
+        "name": "check pcp", "return_value": 0, "message": text,
+    }
+    assert Value.formatted == 1
+
+    ret = {"success": 1, "fail": 0, "skip": 0, "summary": [summary]}
+
+    with caplog.at_level(logging.WARNING):
+        report([ret])
+    assert Value.formatted == 1
+
+    with caplog.at_level(logging.INFO):
+        report([ret])
+    assert text in caplog.messages